@@ -0,0 +1,337 @@
+# Copyright (c) 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+"""Run Ansible through its Python API instead of its command line.
+
+Each run happens in a worker process forked from Rho, so it starts
+with Ansible already imported and the vault password already in
+memory. The worker drives Ansible's TaskQueueManager or
+PlaybookExecutor and sends every host result back over a pipe, where
+it is handed to a Python callback as a rho_events record.
+
+Forking keeps Ansible's global state out of Rho's own process, lets
+concurrent discovery passes run side by side, and lets a run that
+times out be stopped by terminating the worker.
+
+If the API can't be loaded, or the RHO_ANSIBLE_EXECUTOR environment
+variable is 'subprocess', available() is False and callers fall back
+to rho.ansible_utils.run_with_vault.
+"""
+
+from __future__ import print_function
+
+import json
+import multiprocessing
+import os
+import time
+
+from rho import ansible_utils
+from rho import utilities
+from rho.utilities import log
+
+# pylint: disable=ungrouped-imports
+try:
+    from ansible import constants as C
+    from ansible import context
+    from ansible.executor.playbook_executor import PlaybookExecutor
+    from ansible.executor.task_queue_manager import TaskQueueManager
+    from ansible.inventory.manager import InventoryManager
+    from ansible.module_utils._text import to_bytes
+    from ansible.module_utils.common.collections import ImmutableDict
+    from ansible.parsing.dataloader import DataLoader
+    from ansible.parsing.vault import VaultSecret
+    from ansible.playbook.play import Play
+    from ansible.utils.display import Display
+    from ansible.vars.manager import VariableManager
+    from rho.callback_plugins.rho_events import CallbackModule
+except ImportError:
+    context = None
+    CallbackModule = object
+
+EXECUTOR_ENV = 'RHO_ANSIBLE_EXECUTOR'
+
+# Ansible's exit codes for a run where some hosts failed or were
+# unreachable. run_with_vault treats them the same way.
+FAILED_HOSTS_STATUS = 2
+UNREACHABLE_HOSTS_STATUS = 4
+
+
+def available():
+    """Check whether runs can go through the Ansible API.
+
+    :returns: True unless the API is missing or the RHO_ANSIBLE_EXECUTOR
+        environment variable asks for the ansible command instead.
+    """
+    return context is not None and \
+        os.environ.get(EXECUTOR_ENV, 'api') != 'subprocess'
+
+
+class EventCallback(CallbackModule):
+    """Hand rho_events records to a function instead of a file."""
+
+    def __init__(self, on_record):
+        """Create an EventCallback.
+
+        :param on_record: called with each record.
+        """
+        self.on_record = on_record
+        super(EventCallback, self).__init__()
+
+    def emit(self, record):
+        self.on_record(record)
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self.emit({'task': task.get_name(), 'status': 'started'})
+
+    def v2_playbook_on_stats(self, stats):
+        pass
+
+
+def _attach_callback(tqm, callback, quiet):
+    """Add a callback to a TaskQueueManager.
+
+    :param tqm: the TaskQueueManager.
+    :param callback: the callback to add.
+    :param quiet: if True, the callback replaces Ansible's stdout
+        callback, so the run prints nothing.
+    """
+    # pylint: disable=protected-access
+    tqm.load_callbacks()
+    if hasattr(callback, '_init_callback_methods'):
+        callback._init_callback_methods()
+    if not quiet:
+        tqm._callback_plugins.append(callback)
+    elif hasattr(tqm, '_stdout_callback'):
+        # Ansible before 2.19 keeps its stdout callback on its own.
+        tqm._stdout_callback = callback
+    else:
+        tqm._callback_plugins[:] = [callback]
+
+
+def _setup(vault_pass, inventory_path, forks, verbosity, **cli_args):
+    """Set up Ansible's global state in a worker.
+
+    :returns: a loader, inventory and variable manager for the run.
+    """
+    try:
+        from ansible.plugins.loader import init_plugin_loader
+        init_plugin_loader()
+    except ImportError:
+        pass
+    Display().verbosity = verbosity
+    args = {'connection': C.DEFAULT_TRANSPORT, 'module_path': None,
+            'forks': int(forks), 'become': None, 'become_method': None,
+            'become_user': None, 'check': False, 'diff': False,
+            'verbosity': verbosity, 'timeout': C.DEFAULT_TIMEOUT,
+            'syntax': None, 'start_at_task': None, 'listhosts': False,
+            'listtasks': False, 'listtags': False, 'subset': None,
+            'tags': ('all',), 'skip_tags': (), 'extra_vars': ()}
+    args.update(cli_args)
+    context.CLIARGS = ImmutableDict(args)
+
+    loader = DataLoader()
+    loader.set_vault_secrets(
+        [('default', VaultSecret(to_bytes(vault_pass, errors='strict')))])
+    inventory = InventoryManager(loader=loader, sources=[inventory_path])
+    if args['subset']:
+        inventory.subset(args['subset'])
+    variable_manager = VariableManager(loader=loader, inventory=inventory)
+    return loader, inventory, variable_manager
+
+
+def _adhoc_job(vault_pass, inventory_path, pattern, module_name,
+               module_args, forks, verbosity, quiet):
+    """Make a worker job that runs one module on a host pattern."""
+    def job(send):
+        """Run the module and return Ansible's exit code."""
+        loader, inventory, variable_manager = _setup(
+            vault_pass, inventory_path, forks, verbosity)
+        play = Play().load({'name': 'rho ' + module_name,
+                            'hosts': pattern,
+                            'gather_facts': 'no',
+                            'tasks': [{module_name: module_args}]},
+                           variable_manager=variable_manager,
+                           loader=loader)
+        tqm = TaskQueueManager(inventory=inventory,
+                               variable_manager=variable_manager,
+                               loader=loader, passwords={}, forks=int(forks))
+        try:
+            _attach_callback(tqm, EventCallback(send), quiet)
+            return tqm.run(play)
+        finally:
+            tqm.cleanup()
+            loader.cleanup_all_tmp_files()
+    return job
+
+
+def _playbook_job(vault_pass, inventory_path, playbook, limit, extra_vars,
+                  forks, verbosity, quiet):
+    """Make a worker job that runs a playbook."""
+    def job(send):
+        """Run the playbook and return Ansible's exit code."""
+        loader, inventory, variable_manager = _setup(
+            vault_pass, inventory_path, forks, verbosity, subset=limit,
+            extra_vars=(json.dumps(extra_vars or {}),))
+        executor = PlaybookExecutor(playbooks=[playbook],
+                                    inventory=inventory,
+                                    variable_manager=variable_manager,
+                                    loader=loader, passwords={})
+        # pylint: disable=protected-access
+        _attach_callback(executor._tqm, EventCallback(send), quiet)
+        return executor.run()
+    return job
+
+
+def _worker(conn, job, env):
+    """Run a job in the worker process and report back over conn."""
+    if env:
+        os.environ.update(env)
+    try:
+        status = job(lambda record: conn.send(('event', record)))
+        conn.send(('done', status))
+    # pylint: disable=broad-except
+    except Exception as ex:
+        conn.send(('error', str(ex)))
+    finally:
+        conn.close()
+
+
+def _fork_context():
+    """Get a multiprocessing context whose workers are forked."""
+    try:
+        return multiprocessing.get_context('fork')
+    except AttributeError:
+        # Python 2 always forks.
+        return multiprocessing
+
+
+def format_record(record):
+    """Format a rho_events record as a line of log output.
+
+    :param record: the record.
+    :returns: a string without a trailing newline.
+    """
+    if record.get('status') == 'started':
+        return 'TASK [%s]' % record.get('task')
+    line = '%s | %s | %s' % (record.get('host'), record.get('status'),
+                             record.get('task'))
+    if record.get('msg'):
+        line += ' | ' + record['msg']
+    return line
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def _run(job, env=None, on_event=None, log_path=None, log_to_stdout=None,
+         timeout=None, error_on_failure=True):
+    """Run a job in a worker process and wait for it to finish.
+
+    :param job: the job, from _adhoc_job or _playbook_job.
+    :param env: environment variables to set in the worker.
+    :param on_event: called with each rho_events record as it arrives.
+    :param log_path: a path to write one line per record to. Defaults to
+        'XDG_DATA_HOME/rho/ansible_log'.
+    :param log_to_stdout: if not None, also pass each line to this
+        function, as run_with_vault does with Ansible's output.
+    :param timeout: timeout, in seconds, for the whole run.
+    :param error_on_failure: if False, a run that ends because every
+        host failed is not an error.
+    """
+    utilities.ensure_data_dir_exists()
+    log_path = log_path or utilities.ANSIBLE_LOG_PATH
+    deadline = time.time() + timeout if timeout else None
+
+    parent_conn, child_conn = _fork_context().Pipe(duplex=False)
+    worker = _fork_context().Process(target=_worker,
+                                     args=(child_conn, job, env))
+    worker.start()
+    child_conn.close()
+
+    status = None
+    try:
+        with open(log_path, 'w') as logfile:
+            while True:
+                wait = None if deadline is None else \
+                    max(deadline - time.time(), 0)
+                if not parent_conn.poll(wait):
+                    worker.terminate()
+                    raise ansible_utils.AnsibleTimeoutException()
+                try:
+                    kind, value = parent_conn.recv()
+                except EOFError:
+                    raise ansible_utils.AnsibleProcessException(
+                        'Ansible worker exited with status %s' %
+                        worker.exitcode)
+                if kind == 'error':
+                    raise ansible_utils.AnsibleProcessException(
+                        'Ansible run failed: %s' % value)
+                if kind == 'done':
+                    status = value
+                    break
+                line = format_record(value)
+                logfile.write(line + '\n')
+                logfile.flush()
+                if log_to_stdout is not None:
+                    log_to_stdout(line)
+                if on_event is not None:
+                    on_event(value)
+    finally:
+        parent_conn.close()
+        worker.join()
+
+    if status not in (0, UNREACHABLE_HOSTS_STATUS) and \
+            (error_on_failure or status != FAILED_HOSTS_STATUS):
+        raise ansible_utils.AnsibleProcessException(
+            'Ansible run failed with status %s' % status)
+
+
+# pylint: disable=too-many-arguments
+def run_module(inventory_path, vault_pass, pattern, module_name,
+               module_args, forks, ansible_verbosity=0, quiet=True,
+               **kwargs):
+    """Run one module on the hosts of an inventory, like 'ansible'.
+
+    :param inventory_path: the inventory, which may be vault-encrypted.
+    :param vault_pass: the password to the user's Ansible Vault.
+    :param pattern: the hosts or groups to run on.
+    :param module_name: the module, for example 'raw'.
+    :param module_args: the module's free-form arguments.
+    :param forks: the number of Ansible forks.
+    :param ansible_verbosity: the number of v's of Ansible verbosity.
+    :param quiet: if True, Ansible prints nothing to stdout.
+    :param kwargs: passed to _run: env, on_event, log_path,
+        log_to_stdout, timeout and error_on_failure.
+    """
+    log.debug('Running Ansible module %s on %s with inventory %s',
+              module_name, pattern, inventory_path)
+    _run(_adhoc_job(vault_pass, inventory_path, pattern, module_name,
+                    module_args, forks, ansible_verbosity, quiet),
+         **kwargs)
+
+
+# pylint: disable=too-many-arguments
+def run_playbook(playbook, inventory_path, vault_pass, limit, extra_vars,
+                 forks, ansible_verbosity=0, quiet=False, **kwargs):
+    """Run a playbook, like 'ansible-playbook'.
+
+    :param playbook: the path to the playbook.
+    :param inventory_path: the inventory, which may be vault-encrypted.
+    :param vault_pass: the password to the user's Ansible Vault.
+    :param limit: the host pattern to limit the run to, or None.
+    :param extra_vars: a dict of extra variables.
+    :param forks: the number of Ansible forks.
+    :param ansible_verbosity: the number of v's of Ansible verbosity.
+    :param quiet: if True, Ansible prints nothing to stdout.
+    :param kwargs: passed to _run: env, on_event, log_path,
+        log_to_stdout, timeout and error_on_failure.
+    """
+    log.debug('Running Ansible playbook %s on %s with inventory %s',
+              playbook, limit, inventory_path)
+    _run(_playbook_job(vault_pass, inventory_path, playbook, limit,
+                       extra_vars, forks, ansible_verbosity, quiet),
+         **kwargs)
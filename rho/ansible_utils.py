@@ -11,6 +11,8 @@
 
 from __future__ import print_function
 
+import json
+import os
 import time
 import sys
 
@@ -51,6 +53,74 @@ def auth_as_ansible_host_vars(auth):
     return ansible_vars
 
 
+EVENTS_CALLBACK = 'rho_events'
+CALLBACK_PLUGINS_PATH = os.path.join(os.path.dirname(__file__),
+                                     'callback_plugins')
+
+
+def with_event_stream(env, events_path):
+    """Turn on Rho's JSON event callback in an Ansible environment.
+
+    :param env: the environment to run Ansible in. It is changed in place.
+    :param events_path: the file for the callback to write to. It is
+        emptied first.
+    :returns: env
+    """
+    with open(events_path, 'w'):
+        pass
+    plugin_paths = [CALLBACK_PLUGINS_PATH]
+    if env.get('ANSIBLE_CALLBACK_PLUGINS'):
+        plugin_paths.append(env['ANSIBLE_CALLBACK_PLUGINS'])
+    env['ANSIBLE_CALLBACK_PLUGINS'] = os.pathsep.join(plugin_paths)
+    # The setting was renamed in Ansible 2.11; set both names.
+    env['ANSIBLE_CALLBACK_WHITELIST'] = EVENTS_CALLBACK
+    env['ANSIBLE_CALLBACKS_ENABLED'] = EVENTS_CALLBACK
+    # The ansible command only loads callbacks other than its stdout
+    # callback when asked to.
+    env['ANSIBLE_LOAD_CALLBACK_PLUGINS'] = 'True'
+    env['RHO_EVENTS_PATH'] = events_path
+    return env
+
+
+class EventReader(object):
+    """Read the records of a Rho event stream as they are written.
+
+    Each call to read returns only the records written since the last
+    call, so the stream is never read twice.
+    """
+
+    def __init__(self, path):
+        """Create an EventReader.
+
+        :param path: the file the rho_events callback writes to.
+        """
+        self.path = path
+        self.offset = 0
+
+    def read(self):
+        """Read the complete records written since the last call.
+
+        :returns: a list of dicts, one per record.
+        """
+        try:
+            with open(self.path, 'rb') as events_file:
+                events_file.seek(self.offset)
+                data = events_file.read()
+        except IOError:
+            return []
+
+        # A record that is still being written is left for next time.
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+        events = []
+        for line in data[:end].splitlines():
+            try:
+                events.append(json.loads(line.decode('utf-8')))
+            except ValueError:
+                log.warning('Skipping malformed Ansible event: %r', line)
+        return events
+
+
 def redact_dict(redact_key_list, a_dict):
     """Redact_values in a dictionary
 
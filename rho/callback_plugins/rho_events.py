@@ -0,0 +1,93 @@
+# Copyright (c) 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+"""Ansible callback that writes one JSON record per host result.
+
+Rho turns this callback on for the Ansible processes it starts and
+reads the records back with rho.ansible_utils.EventReader, instead of
+parsing Ansible's human-readable output. The records go to the file
+named by the RHO_EVENTS_PATH environment variable, one JSON object per
+line, with the keys 'host', 'task', 'status' ('ok', 'failed',
+'unreachable' or 'skipped'), 'stdout' for successful commands and 'msg'
+for failures.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+
+import json
+import os
+
+from ansible.plugins.callback import CallbackBase
+
+# pylint: disable=invalid-name
+__metaclass__ = type
+
+DOCUMENTATION = '''
+    name: rho_events
+    type: notification
+    short_description: write host results as JSON lines for Rho
+    description:
+      - Writes one JSON record per host result to the file named by the
+        RHO_EVENTS_PATH environment variable.
+'''
+
+EVENTS_PATH_ENV = 'RHO_EVENTS_PATH'
+
+
+class CallbackModule(CallbackBase):
+    """Write host results to RHO_EVENTS_PATH as JSON lines."""
+
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'notification'
+    CALLBACK_NAME = 'rho_events'
+    CALLBACK_NEEDS_WHITELIST = True
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+        path = os.environ.get(EVENTS_PATH_ENV)
+        self.events = open(path, 'a') if path else None
+
+    def _write(self, result, status):
+        """Build the record for a host result and emit it."""
+        # pylint: disable=protected-access
+        record = {'host': result._host.get_name(),
+                  'task': result._task.get_name(),
+                  'status': status}
+        if status == 'ok' and 'stdout' in result._result:
+            record['stdout'] = result._result['stdout']
+        if status in ('failed', 'unreachable'):
+            msg = result._result.get('msg')
+            if msg:
+                record['msg'] = msg
+        self.emit(record)
+
+    def emit(self, record):
+        """Write one record and flush it, so readers see it right away."""
+        if self.events is None:
+            return
+        self.events.write(json.dumps(record) + '\n')
+        self.events.flush()
+
+    def v2_runner_on_ok(self, result):
+        self._write(result, 'ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._write(result, 'failed')
+
+    def v2_runner_on_unreachable(self, result):
+        self._write(result, 'unreachable')
+
+    def v2_runner_on_skipped(self, result):
+        self._write(result, 'skipped')
+
+    def v2_playbook_on_stats(self, stats):
+        if self.events is not None:
+            self.events.close()
+            self.events = None
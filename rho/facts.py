@@ -109,6 +109,9 @@ new_fact('connection.port', 'The port used for the connection',
          is_default=True, is_sensitive=True, always_collect=True)
 new_fact('connection.uuid', 'A generated identifier for the connection',
          is_default=True, always_collect=True)
+new_fact('connection.aliases',
+         'Other addresses of the system that were found during discovery',
+         is_default=True, is_sensitive=True, always_collect=True)
 new_fact('cpu.bogomips', 'measurement of CPU speed made by the Linux kernel',
          is_default=True, categories=[RHEL_FACTS])
 new_fact('cpu.count', 'number of processors',
@@ -11,65 +11,90 @@
 
 from __future__ import print_function
 from collections import defaultdict
+import base64
+import errno
+import hashlib
+import itertools
+import math
 import os
-import re
+import select
+import socket
+import string
+import threading
+import time
+from ansible.errors import AnsibleError
 from ansible.parsing.utils.addresses import parse_address
-from ansible.plugins.inventory import detect_range, expand_hostname_range
+from ansible.plugins.inventory import detect_range
+from rho import ansible_executor
 from rho import ansible_utils
 from rho.translation import _
-from rho.utilities import (log, PING_INVENTORY_PATH,
-                           PING_LOG_PATH,
-                           process_discovery_scan)
+from rho.utilities import (iteritems, log, PING_INVENTORY_PATH,
+                           PING_LOG_PATH, PING_EVENTS_PATH, exclude_ranges,
+                           ranges_to_intervals)
 
 
-def process_ping_output(out_lines):
-    """Find successful hosts from the output of a ping command.
+def _range_values(nrange):
+    """Generate the values of the inside of one [begin:end:step] range.
 
-    Use this function by using ansible to run echo "Hello" on remote
-    hosts, then sending the output to this function.
+    This follows the rules of Ansible's expand_hostname_range: numeric
+    or single-letter bounds, an optional step, and zero padding when
+    the begin value has a leading zero.
 
-    :param out_lines: an iterator returning lines of Ansible output.
-    :returns: the hosts that pinged successfully, as a set and those that
-        failed, as a set.
+    :param nrange: the text between the brackets, like '01:10:2'
+    :returns: a generator of strings
     """
+    bounds = nrange.split(':')
+    if len(bounds) not in (2, 3):
+        raise AnsibleError('host range must be begin:end or '
+                           'begin:end:step')
+    beg = bounds[0] or '0'
+    end = bounds[1]
+    step = int(bounds[2]) if len(bounds) == 3 else 1
+    if not end:
+        raise AnsibleError('host range must specify end value')
+
+    if beg in string.ascii_letters and end in string.ascii_letters:
+        i_beg = string.ascii_letters.index(beg)
+        i_end = string.ascii_letters.index(end)
+        if i_beg > i_end:
+            raise AnsibleError('host range must have begin <= end')
+        for letter in string.ascii_letters[i_beg:i_end + 1:step]:
+            yield letter
+        return
+
+    width = 0
+    if beg[0] == '0' and len(beg) > 1:
+        width = len(beg)
+        if width != len(end):
+            raise AnsibleError('host range must specify equal-length '
+                               'begin and end formats')
+    value = int(beg)
+    while value <= int(end):
+        yield str(value).zfill(width)
+        value += step
+
+
+def _iter_pattern(pattern):
+    """Generate the hosts of a pattern that may contain [x:y] ranges."""
+    if not detect_range(pattern):
+        yield pattern
+        return
+
+    head, nrange, tail = \
+        pattern.replace('[', '|', 1).replace(']', '|', 1).split('|')
+    for value in _range_values(nrange):
+        for host in _iter_pattern(head + value + tail):
+            yield host
 
-    success_hosts = set()
-    failed_hosts = set()
-    unreachable_hosts = set()
 
-    # Ansible output has the format
-    # host | UNREACHABLE! => {
-    #     "changed": false,
-    #     "msg": "Failed to connect to the host via ssh ...",
-    #     "unreachable": true
-    #    }
-    #   hostname | SUCCESS | rc=0 >>
-    #   Hello
-    # with the above two lines repeated for each host
-    for line in out_lines:
-        ansi_escape = re.compile(r'\x1b[^m]*m')
-        line = ansi_escape.sub('', line)
-        pieces = line.split('|')
-        if len(pieces) == 3 and pieces[1].strip() == 'SUCCESS':
-            success_hosts.add(pieces[0].strip())
-        elif len(pieces) == 3 and pieces[1].strip() == 'FAILED':
-            failed_hosts.add(pieces[0].strip())
-        elif len(pieces) == 2 and pieces[1].strip().startswith('UNREACHABLE'):
-            unreachable_hosts.add(pieces[0].strip())
-
-    log.info('Ping log reached hosts: %s', success_hosts)
-    log.info('Ping log failed hosts: %s', failed_hosts)
-    log.info('Ping log unreachable hosts: %s', unreachable_hosts)
-
-    return success_hosts, failed_hosts, unreachable_hosts
-
-
-def _expand_hostpattern(hostpattern):
-    """Expands pattern into list of hosts.
-
-    Takes a single host pattern and returns a list of hostnames.
+def iter_hostpattern(hostpattern):
+    """Expand a host pattern into hostnames, one at a time.
+
+    Unlike Ansible's expand_hostname_range, this never builds the list
+    of hosts, so a /8 costs no more memory than a single address.
+
     :param hostpattern: a single host pattern
-    :returns: list of hostnames
+    :returns: a generator of hostnames
     """
     # Can the given hostpattern be parsed as a host with an optional port
     # specification?
@@ -81,111 +106,657 @@ def _expand_hostpattern(hostpattern):
         # not a recognizable host pattern
         pattern = hostpattern
 
-    # Once we have separated the pattern, we expand it into list of one or
-    # more hostnames, depending on whether it contains any [x:y] ranges.
+    return _iter_pattern(pattern)
 
-    if detect_range(pattern):
-        hostnames = expand_hostname_range(pattern)
-    else:
-        hostnames = [pattern]
 
-    return hostnames
+def iter_hosts(profile_ranges):
+    """Expand all of a profile's host patterns, one host at a time.
 
+    :param profile_ranges: a list of host patterns
+    :returns: a generator of hostnames
+    """
+    for profile_range in profile_ranges:
+        for host in iter_hostpattern(profile_range):
+            yield host
 
-# Creates the inventory for pinging all hosts and records
-# successful auths and the hosts they worked on
-# pylint: disable=too-many-statements, too-many-arguments, unused-argument
-def create_ping_inventory(vault, vault_pass, profile_ranges, profile_port,
-                          credential, forks, ansible_verbosity):
 
-    """Find which auths work with which hosts.
+def candidate_hosts(profile_ranges, exclude_hosts=None):
+    """Generate the hosts of a profile, leaving out excluded hosts.
 
-    :param vault: a Vault object
-    :param vault_pass: password for the Vault?
-    :param profile_ranges: hosts for the profile
-    :param profile_port: the SSH port to use
-    :param credential: auth to use
-    :param forks: the number of Ansible forks to use
+    IP address exclusions are subtracted from the profile's ranges
+    before anything is expanded, so excluded subnets cost nothing. Host
+    name exclusions are matched against each expanded host.
 
-    :returns: a tuple of
-      (list of IP addresses that worked for any auth,
-       map from host IPs to SSH ports that worked with them,
-       map from host IPs to lists of auths that worked with them
-      )
+    :param profile_ranges: a list of host patterns in Ansible format
+    :param exclude_hosts: a list of host patterns in Ansible format to
+        leave out, or None
+    :returns: a generator of host names and addresses
     """
+    exclude_hosts = exclude_hosts or []
+    ranges = exclude_ranges(profile_ranges, exclude_hosts)
+    _, excluded_patterns = ranges_to_intervals(exclude_hosts)
+    excluded_names = set(iter_hosts(excluded_patterns))
+    for host in iter_hosts(ranges):
+        if host not in excluded_names:
+            yield host
 
-    # pylint: disable=too-many-locals
-    all_hosts = []
-    success_hosts = set()
-    failed_hosts = set()
-    unreachable_hosts = set()
-    success_port_map = defaultdict()
-    success_auth_map = defaultdict(list)
-    hosts_dict = {}
 
-    for profile_range in profile_ranges:
-        hosts = _expand_hostpattern(profile_range)
-        all_hosts += hosts
+def batches(iterable, size):
+    """Split an iterable into lists of at most size items.
+
+    :param iterable: the items to split. Only one batch of them is held
+        in memory at a time.
+    :param size: the largest batch to make.
+    :returns: a generator of lists
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+PROBE_TIMEOUT = 5
+PROBE_BATCH_SIZE = 10000
+PROBE_CONCURRENCY = 2000
+# Without poll() we fall back to select(), which can't watch
+# descriptors numbered above FD_SETSIZE (usually 1024).
+SELECT_CONCURRENCY = 500
+MAX_BANNER_BYTES = 4096
+
+
+def _probe_concurrency(max_concurrent):
+    """Limit probe concurrency to what this process can hold open.
+
+    :param max_concurrent: the requested number of concurrent probes.
+    :returns: the number of concurrent probes to use.
+    """
+    if not hasattr(select, 'poll'):
+        max_concurrent = min(max_concurrent, SELECT_CONCURRENCY)
+    try:
+        import resource
+        soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if soft_limit != resource.RLIM_INFINITY:
+            max_concurrent = min(max_concurrent, soft_limit - 64)
+    except (ImportError, ValueError):
+        pass
+    return max(1, max_concurrent)
+
+
+class _Poller(object):
+    """A minimal wrapper over poll(), falling back to select()."""
+
+    def __init__(self):
+        self.poller = select.poll() if hasattr(select, 'poll') else None
+        self.events = {}
+
+    def register(self, fileno, want_write):
+        """Watch a descriptor for writability or readability."""
+        self.events[fileno] = want_write
+        if self.poller is not None:
+            flags = select.POLLOUT if want_write else select.POLLIN
+            self.poller.register(fileno, flags)
+
+    def unregister(self, fileno):
+        """Stop watching a descriptor."""
+        del self.events[fileno]
+        if self.poller is not None:
+            self.poller.unregister(fileno)
+
+    def poll(self, timeout):
+        """Wait for events.
+
+        :param timeout: how long to wait, in seconds.
+        :returns: a list of ready descriptors.
+        """
+        if self.poller is not None:
+            return [fileno for fileno, _ in
+                    self.poller.poll(int(timeout * 1000) + 1)]
+        readers = [fileno for fileno, want_write in self.events.items()
+                   if not want_write]
+        writers = [fileno for fileno, want_write in self.events.items()
+                   if want_write]
+        readable, writable, errored = select.select(readers, writers,
+                                                    readers + writers,
+                                                    timeout)
+        return list(set(readable + writable + errored))
+
+
+def _start_probe(host, port):
+    """Start a non-blocking connection to a host.
+
+    :returns: a tuple of (socket, None) if the connection is in progress,
+        or (None, reason) if it failed right away.
+    """
+    try:
+        family, socktype, proto, _, address = socket.getaddrinfo(
+            host, port, 0, socket.SOCK_STREAM)[0]
+    except socket.error:
+        return None, 'could not resolve host name'
+
+    sock = socket.socket(family, socktype, proto)
+    sock.setblocking(0)
+    err = sock.connect_ex(address)
+    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+        sock.close()
+        return None, os.strerror(err).lower()
+    return sock, None
+
+
+# pylint: disable=too-many-locals, too-many-branches, too-many-statements
+def probe_ssh_hosts(hosts, port, timeout=None, max_concurrent=None):
+    """Find which hosts have an SSH server listening.
+
+    Opens non-blocking connections to many hosts at once and waits for
+    each one to send an SSH banner. This is much cheaper than letting an
+    Ansible fork wait out the SSH connect timeout on every dead address.
+
+    :param hosts: an iterable of host names or IP addresses.
+    :param port: the SSH port to connect to.
+    :param timeout: seconds to wait for each host to connect and send
+        its banner. Defaults to the RHO_PREPROBE_TIMEOUT environment
+        variable, or PROBE_TIMEOUT.
+    :param max_concurrent: the most connections to have open at once.
+    :returns: a tuple of (list of hosts that sent an SSH banner,
+        map from each other host to the reason it was skipped,
+        map from each host that sent a banner to the seconds its TCP
+        connection took).
+    """
+    if timeout is None:
+        timeout = float(os.getenv('RHO_PREPROBE_TIMEOUT', PROBE_TIMEOUT))
+    max_concurrent = _probe_concurrency(max_concurrent or PROBE_CONCURRENCY)
+    port = int(port)
+
+    live_hosts = []
+    skipped = {}
+    rtts = {}
+    # fileno -> [host, socket, deadline, connected, banner bytes,
+    #            start time, connect time]
+    active = {}
+    poller = _Poller()
+    pending = iter(hosts)
+    exhausted = False
+
+    def finish(fileno, reason=None):
+        """Stop probing a host and record the outcome."""
+        host, sock, rtt = active[fileno][0], active[fileno][1], \
+            active[fileno][6]
+        poller.unregister(fileno)
+        del active[fileno]
+        sock.close()
+        if reason is None:
+            live_hosts.append(host)
+            rtts[host] = rtt
+        else:
+            skipped[host] = reason
+
+    while active or not exhausted:
+        while not exhausted and len(active) < max_concurrent:
+            try:
+                host = next(pending)
+            except StopIteration:
+                exhausted = True
+                break
+            sock, reason = _start_probe(host, port)
+            if sock is None:
+                skipped[host] = reason
+                continue
+            started = time.time()
+            active[sock.fileno()] = [host, sock, started + timeout,
+                                     False, b'', started, None]
+            poller.register(sock.fileno(), True)
+
+        if not active:
+            continue
+
+        now = time.time()
+        wait = max(0, min(probe[2] for probe in active.values()) - now)
+        for fileno in poller.poll(wait):
+            if fileno not in active:
+                continue
+            probe = active[fileno]
+            sock = probe[1]
+            if not probe[3]:
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    finish(fileno, os.strerror(err).lower())
+                    continue
+                probe[3] = True
+                probe[6] = time.time() - probe[5]
+                poller.unregister(fileno)
+                poller.register(fileno, False)
+                continue
+
+            try:
+                data = sock.recv(1024)
+            except socket.error as ex:
+                finish(fileno, os.strerror(ex.errno).lower())
+                continue
+            if not data:
+                finish(fileno, 'closed the connection without an SSH '
+                               'banner')
+                continue
+            probe[4] += data
+            # RFC 4253 lets servers send other lines before the
+            # identification string, so look at every complete line.
+            lines = probe[4].split(b'\n')
+            if any(line.startswith(b'SSH-') for line in lines[:-1]):
+                finish(fileno)
+            elif len(probe[4]) > MAX_BANNER_BYTES:
+                finish(fileno, 'did not send an SSH banner')
+
+        now = time.time()
+        for fileno in [fileno for fileno, probe in active.items()
+                       if probe[2] <= now]:
+            if active[fileno][3]:
+                finish(fileno, 'timed out waiting for an SSH banner')
+            else:
+                finish(fileno, 'timed out connecting')
+
+    return live_hosts, skipped, rtts
+
+
+PING_CHUNK_SIZE = 1000
+
+# The discovery ping also prints what host_identity needs to tell
+# whether two addresses belong to the same machine. It always succeeds
+# once the login has worked.
+PING_COMMAND = ('echo "Hello"; uname -n; '
+                'cat /etc/ssh/ssh_host_*_key.pub 2>/dev/null; true')
+
+
+def host_identity(ping_output):
+    """Identify a machine from the output of PING_COMMAND.
+
+    Addresses of the same machine have the same host name and the same
+    SSH host keys. Both are used, so that cloned machines that share
+    host keys are still told apart by name.
+
+    :param ping_output: the standard output of PING_COMMAND.
+    :returns: a string like 'myhost SHA256:...', or None if the output
+        holds no host keys.
+    """
+    host_name = None
+    key_blobs = []
+    for line in ping_output.splitlines():
+        fields = line.strip().split()
+        if not fields or fields == ['Hello']:
+            continue
+        if len(fields) >= 2 and (fields[0].startswith('ssh-') or
+                                 fields[0].startswith('ecdsa-')):
+            try:
+                key_blobs.append(base64.b64decode(fields[1]))
+            except (TypeError, ValueError):
+                continue
+        elif host_name is None:
+            host_name = fields[0]
+
+    if not key_blobs:
+        return None
+    digest = hashlib.sha256(b''.join(sorted(key_blobs))).digest()
+    fingerprint = base64.b64encode(digest).decode('ascii').rstrip('=')
+    return '{0} SHA256:{1}'.format(host_name, fingerprint)
+
+
+def collapse_aliases(hosts, identity_map):
+    """Keep one address per machine.
+
+    :param hosts: a list of hosts, in order of preference.
+    :param identity_map: a map from hosts to their host_identity. Hosts
+        without one are always kept.
+    :returns: a tuple of (the hosts to keep, in order, map from each
+        kept host with other addresses to the list of those addresses)
+    """
+    primaries = {}
+    kept = []
+    alias_map = {}
+    for host in hosts:
+        identity = identity_map.get(host)
+        if identity is None:
+            kept.append(host)
+        elif identity in primaries:
+            alias_map.setdefault(primaries[identity], []).append(host)
+        else:
+            primaries[identity] = host
+            kept.append(host)
+    return kept, alias_map
+
+
+class DiscoveryProgress(object):
+    """Follow a discovery pass through its Ansible event stream.
+
+    The stream is read as the pass runs, to show progress and to build
+    the sets of hosts that succeeded, failed and were unreachable.
+    """
+
+    # How often to print progress, in processed hosts.
+    REPORT_EVERY = 5
+
+    def __init__(self, events_path, credential_name, show_progress):
+        """Create a DiscoveryProgress.
+
+        :param events_path: the file the rho_events callback writes to,
+            or None if the events are passed to handle directly.
+        :param credential_name: the name of the auth the pass uses.
+        :param show_progress: whether to print progress as it comes in.
+        """
+        self.reader = ansible_utils.EventReader(events_path) \
+            if events_path else None
+        self.credential_name = credential_name
+        self.show_progress = show_progress
+        self.success = set()
+        self.failed = set()
+        self.unreachable = set()
+        self.identities = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def update(self):
+        """Read the events written since the last update."""
+        if self.reader is None:
+            return
+        with self._lock:
+            events = self.reader.read()
+        for event in events:
+            self.handle(event)
+
+    def handle(self, event):
+        """Record one event.
+
+        :param event: a rho_events record.
+        """
+        with self._lock:
+            status = event.get('status')
+            if status == 'ok':
+                self.success.add(event.get('host'))
+                identity = host_identity(event.get('stdout', ''))
+                if identity is not None:
+                    self.identities[event.get('host')] = identity
+            elif status == 'failed':
+                self.failed.add(event.get('host'))
+            elif status == 'unreachable':
+                self.unreachable.add(event.get('host'))
+            else:
+                return
+            if self.show_progress and \
+                    self.processed() % self.REPORT_EVERY == 0:
+                self.report()
+
+    def processed(self):
+        """Count the hosts with a result so far."""
+        return len(self.success) + len(self.failed) + len(self.unreachable)
+
+    def report(self):
+        """Print the results so far."""
+        print(_('%d hosts processed with credential %s. ' %
+                (self.processed(), self.credential_name)))
+        if self.success:
+            print(_('%d hosts connected successfully with '
+                    'credential %s.' % (len(self.success),
+                                        self.credential_name)))
+        if self.failed:
+            print(_('%d hosts failed to connect with '
+                    'credential %s.' % (len(self.failed),
+                                        self.credential_name)))
+        if self.unreachable:
+            print(_('%d hosts were unreachable.' % len(self.unreachable)))
+        print('\n')
+
+    def start(self, interval=1):
+        """Follow the stream in the background until stop is called.
+
+        :param interval: how often to check for new events, in seconds.
+        """
+        def follow():
+            """Update until stopped."""
+            while not self._stopped.wait(interval):
+                self.update()
+
+        if self.show_progress:
+            self._thread = threading.Thread(target=follow)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop following the stream and read what is left of it."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.update()
+
+
+# Discovery timeouts, in seconds. A probed host's SSH connect timeout
+# is RTT_TIMEOUT_FACTOR times the larger of its own TCP connect time and
+# the 95th percentile of everyone's, kept between the MIN and MAX. Hosts
+# that weren't probed get DEFAULT_CONNECT_TIMEOUT.
+MIN_CONNECT_TIMEOUT = 3
+MAX_CONNECT_TIMEOUT = 30
+DEFAULT_CONNECT_TIMEOUT = 10
+RTT_TIMEOUT_FACTOR = 20
+# Time for a host to log in and run PING_COMMAND once it is connected.
+LOGIN_ALLOWANCE = 30
+
+
+def percentile(values, fraction):
+    """Find a percentile of a list of numbers, by the nearest rank.
+
+    :param values: a non-empty list of numbers.
+    :param fraction: the percentile, between 0 and 1.
+    :returns: the value at that percentile.
+    """
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def connect_timeouts(rtts):
+    """Pick an SSH connect timeout for each probed host.
+
+    Slow networks get longer timeouts, but one slow host only changes
+    its own timeout.
+
+    :param rtts: a map from hosts to their TCP connect time, in seconds,
+        as returned by probe_ssh_hosts.
+    :returns: a map from hosts to whole seconds.
+    """
+    if not rtts:
+        return {}
+    typical = percentile(list(rtts.values()), 0.95)
+    timeouts = {}
+    for host, rtt in iteritems(rtts):
+        timeout = int(math.ceil(RTT_TIMEOUT_FACTOR * max(rtt, typical)))
+        timeouts[host] = max(MIN_CONNECT_TIMEOUT,
+                             min(MAX_CONNECT_TIMEOUT, timeout))
+    return timeouts
+
+
+def host_deadline(connect_timeout):
+    """Get the longest a discovery ping should take on one host.
+
+    The ping's SSH session sends keepalives every connect_timeout
+    seconds and gives up after two go unanswered, so a host that stops
+    answering is dropped after three times its connect timeout.
+
+    :param connect_timeout: the host's SSH connect timeout, in seconds.
+    :returns: the deadline, in seconds.
+    """
+    return 3 * connect_timeout + LOGIN_ALLOWANCE
+
+
+def pass_timeout(timeouts, forks):
+    """Get the timeout for a whole discovery ping.
+
+    Ansible pings forks hosts at a time, so the pass is bounded by the
+    number of waves times the slowest host's deadline. If the
+    RHO_DISCOVERY_TIMEOUT environment variable is set, each wave gets
+    that many minutes instead.
 
-    for host in all_hosts:
+    :param timeouts: the connect timeout of each host in the pass.
+    :param forks: the number of Ansible forks.
+    :returns: the timeout, in seconds.
+    """
+    waves = (len(timeouts) + int(forks) - 1) // int(forks)
+    if os.getenv('RHO_DISCOVERY_TIMEOUT'):
+        return waves * int(os.getenv('RHO_DISCOVERY_TIMEOUT')) * 60
+    return waves * max(host_deadline(timeout) for timeout in timeouts)
+
+
+# pylint: disable=too-many-arguments, too-many-locals
+def _ping_chunk(vault, vault_pass, hosts, profile_port, credential, forks,
+                inventory_path, log_path, events_path, show_progress,
+                timeouts=None):
+    """Run the discovery ping over one chunk of hosts.
+
+    :param hosts: the list of hosts in this chunk.
+    :param timeouts: a map from hosts to their SSH connect timeout, from
+        connect_timeouts, or None.
+    :returns: the sets of hosts that succeeded, failed and were
+        unreachable, and a map from successful hosts to their
+        host_identity.
+    """
+    timeouts = timeouts or {}
+    hosts_dict = {}
+    chunk_timeouts = []
+    for host in hosts:
+        timeout = timeouts.get(host, DEFAULT_CONNECT_TIMEOUT)
+        chunk_timeouts.append(timeout)
         hosts_dict[host] = {'ansible_host': host,
-                            'ansible_port': profile_port}
+                            'ansible_port': profile_port,
+                            'ansible_timeout': timeout,
+                            'ansible_ssh_common_args':
+                                '-o ServerAliveInterval={0} '
+                                '-o ServerAliveCountMax=2'.format(timeout)}
 
     vars_dict = ansible_utils.auth_as_ansible_host_vars(credential)
 
     yml_dict = {'alpha': {'hosts': hosts_dict, 'vars': vars_dict}}
-    vault.dump_as_yaml_to_file(yml_dict, PING_INVENTORY_PATH)
+    vault.dump_as_yaml_to_file(yml_dict, inventory_path)
     ansible_utils.log_yaml_inventory('Ping inventory', yml_dict)
 
-    total_hosts_count = len(all_hosts)
-    rho_discovery_timeout = os.getenv('RHO_DISCOVERY_TIMEOUT', 5)
-    discovery_timeout = ((total_hosts_count // int(forks)) + 1) \
-        * rho_discovery_timeout
+    total_hosts_count = len(hosts)
+    discovery_timeout = pass_timeout(chunk_timeouts, forks)
 
     log.info('Attempting connection discovery to %d systems'
-             ' with auth "%s" using a timeout of %d minutes.',
+             ' with auth "%s" using a timeout of %d seconds.',
              total_hosts_count, credential.get('name'), discovery_timeout)
     print(_('Attempting connection discovery to %d systems'
-            ' with auth "%s" using a timeout of %d minutes.' %
+            ' with auth "%s" using a timeout of %d seconds.' %
             (total_hosts_count, credential.get('name'), discovery_timeout)))
 
     cmd_string = 'ansible alpha -m raw' \
-                 ' -i ' + PING_INVENTORY_PATH \
+                 ' -i ' + inventory_path \
                  + ' --ask-vault-pass -f ' + forks \
-                 + ' --ssh-common-args="-o ServerAliveInterval=10"' \
-                 + ' -a \'echo "Hello"\''
+                 + ' -a \'' + PING_COMMAND + '\''
 
     my_env = os.environ.copy()
     my_env["ANSIBLE_HOST_KEY_CHECKING"] = "False"
     my_env["ANSIBLE_NOCOLOR"] = "True"
-    log_env = {'RHO_CREDENTIAL_NAME': credential.get('name'),
-               'RHO_HOST_PROCESSED': '0',
-               'RHO_HOST_SUCCESSFUL': '0',
-               'RHO_HOST_UNREACHABLE': '0',
-               'RHO_HOST_FAILED': '0'}
-    # Don't pass ansible_verbosity here as adding too much
-    # verbosity can break our parsing of Ansible's output. This is
-    # a temporary fix - a better solution would be less-fragile
-    # output parsing.
+    in_process = ansible_executor.available()
+    if not in_process:
+        ansible_utils.with_event_stream(my_env, events_path)
+    progress = DiscoveryProgress(None if in_process else events_path,
+                                 credential.get('name'), show_progress)
     try:
-        ansible_utils.run_with_vault(
-            cmd_string, vault_pass,
-            log_path=PING_LOG_PATH,
-            env=my_env,
-            log_to_stdout=process_discovery_scan,
-            log_to_stdout_env=log_env,
-            ansible_verbosity=0,
-            timeout=discovery_timeout * 60,
-            error_on_failure=False)
+        if in_process:
+            ansible_executor.run_module(
+                inventory_path, vault_pass, 'alpha', 'raw', PING_COMMAND,
+                forks, env=my_env, on_event=progress.handle,
+                log_path=log_path, timeout=discovery_timeout,
+                error_on_failure=False)
+        else:
+            progress.start()
+            ansible_utils.run_with_vault(
+                cmd_string, vault_pass,
+                log_path=log_path,
+                env=my_env,
+                ansible_verbosity=0,
+                timeout=discovery_timeout,
+                error_on_failure=False)
     except ansible_utils.AnsibleTimeoutException:
-        # If the discovery scan times out, we'll just parse whatever
-        # information we have in the log file.
+        # If the discovery scan times out, we'll just use whatever
+        # results came in before it did.
         log.warning('Host discovery timed out. Gathering available host '
                     'information to proceed with scan.')
+    finally:
+        progress.stop()
+
+    log.info('Ping reached hosts: %s', progress.success)
+    log.info('Ping failed hosts: %s', progress.failed)
+    log.info('Ping unreachable hosts: %s', progress.unreachable)
+
+    return progress.success, progress.failed, progress.unreachable, \
+        progress.identities
+
+
+# Creates the inventory for pinging all hosts and records
+# successful auths and the hosts they worked on
+# pylint: disable=too-many-statements, too-many-arguments, unused-argument
+def create_ping_inventory(vault, vault_pass, profile_ranges, profile_port,
+                          credential, forks, ansible_verbosity,
+                          inventory_path=None, log_path=None,
+                          events_path=None, show_progress=True,
+                          chunk_size=None, timeouts=None):
+
+    """Find which auths work with which hosts.
+
+    The hosts are expanded lazily and pinged in chunks, each with its
+    own inventory file, so memory use doesn't grow with the size of the
+    profile's ranges.
 
-    with open(PING_LOG_PATH, 'r') as ping_log:
-        success_hosts, failed_hosts, unreachable_hosts = \
-            process_ping_output(ping_log)
+    :param vault: a Vault object
+    :param vault_pass: password for the Vault?
+    :param profile_ranges: hosts for the profile
+    :param profile_port: the SSH port to use
+    :param credential: auth to use
+    :param forks: the number of Ansible forks to use
+    :param inventory_path: where to write the ping inventory. Defaults to
+        PING_INVENTORY_PATH.
+    :param log_path: where to write the Ansible log. Defaults to
+        PING_LOG_PATH.
+    :param events_path: where Ansible writes its JSON event stream.
+        Defaults to PING_EVENTS_PATH.
+    :param show_progress: whether to echo per-host progress while the
+        pass runs. Concurrent passes share stdout, so they turn this off.
+    :param chunk_size: the most hosts to put in one ping inventory.
+        Defaults to the RHO_DISCOVERY_CHUNK_SIZE environment variable, or
+        PING_CHUNK_SIZE.
+    :param timeouts: a map from hosts to their SSH connect timeout, from
+        connect_timeouts. Hosts not in it get DEFAULT_CONNECT_TIMEOUT.
+
+    :returns: a tuple of
+      (list of IP addresses that worked for any auth,
+       map from host IPs to SSH ports that worked with them,
+       map from host IPs to lists of auths that worked with them,
+       list of IP addresses where the auth failed,
+       list of unreachable IP addresses,
+       map from host IPs that worked to their host_identity
+      )
+    """
+
+    # pylint: disable=too-many-locals
+    success_hosts = set()
+    failed_hosts = set()
+    unreachable_hosts = set()
+    success_port_map = defaultdict()
+    success_auth_map = defaultdict(list)
+    identity_map = {}
+    inventory_path = inventory_path or PING_INVENTORY_PATH
+    log_path = log_path or PING_LOG_PATH
+    events_path = events_path or PING_EVENTS_PATH
+    chunk_size = chunk_size or int(os.getenv('RHO_DISCOVERY_CHUNK_SIZE',
+                                             PING_CHUNK_SIZE))
+
+    for chunk in batches(iter_hosts(profile_ranges), chunk_size):
+        success_, failed_, unreachable_, identities_ = _ping_chunk(
+            vault, vault_pass, chunk, profile_port, credential, forks,
+            inventory_path, log_path, events_path, show_progress,
+            timeouts)
+        identity_map.update(identities_)
+        success_hosts.update(success_)
+        failed_hosts.update(failed_)
+        unreachable_hosts.update(unreachable_)
 
     for host in success_hosts:
         success_auth_map[host].append(credential)
@@ -211,4 +782,443 @@ def create_ping_inventory(vault, vault_pass, profile_ranges, profile_port,
         print('')
 
     return list(success_hosts), success_port_map, success_auth_map, \
-        list(failed_hosts), list(unreachable_hosts)
+        list(failed_hosts), list(unreachable_hosts), identity_map
+
+
+def _pass_path(path, index):
+    """Get the per-pass version of a discovery file path.
+
+    :param path: a discovery file path, like PING_INVENTORY_PATH.
+    :param index: the index of the pass within its round.
+    :returns: path, with the index inserted before the extension.
+    """
+    root, ext = os.path.splitext(path)
+    return '{0}-{1}{2}'.format(root, index, ext)
+
+
+def subnet_key(host):
+    """Get the key for a host's credential statistics.
+
+    :param host: an IP address or host name.
+    :returns: the host's /24 network, like '10.0.1.0/24', or None if host
+        is not an IPv4 address.
+    """
+    octets = host.split('.')
+    if len(octets) != 4 or not all(octet.isdigit() for octet in octets):
+        return None
+    return '.'.join(octets[:3]) + '.0/24'
+
+
+def credential_order(host, host_index, credentials, stats):
+    """Order the credentials to try on a host.
+
+    Without statistics, host i starts with credential i and then walks
+    the credential list in order, so the first round of discovery is
+    spread over every credential. Credentials that have worked well on
+    the host's /24 network move to the front.
+
+    :param host: an IP address or host name.
+    :param host_index: the position of the host in the discovery.
+    :param credentials: the auths to try, in the profile's order.
+    :param stats: credential statistics, as returned by
+        load_credential_stats.
+    :returns: a list of indices into credentials.
+    """
+    num_credentials = len(credentials)
+    order = [(host_index + i) % num_credentials
+             for i in range(num_credentials)]
+    subnet_stats = stats.get(subnet_key(host)) or {}
+    if not subnet_stats:
+        return order
+
+    def success_rate(index):
+        """Estimate how likely a credential is to work on the subnet."""
+        successes, attempts = subnet_stats.get(
+            credentials[index].get('id'), (0, 0))
+        return (successes + 1.0) / (attempts + 2.0)
+
+    # sorted is stable, so credentials with the same rate keep their
+    # rotated order.
+    return sorted(order, key=lambda index: -success_rate(index))
+
+
+# pylint: disable=too-many-arguments
+def _run_discovery_passes(vault, vault_pass, jobs, profile_port, forks,
+                          ansible_verbosity, timeouts=None):
+    """Run several discovery passes at the same time.
+
+    :param jobs: a list of (hosts, credential) pairs, one per pass.
+    :param timeouts: a map from hosts to their SSH connect timeout.
+    :returns: a list with the create_ping_inventory result of each job.
+    """
+    results = [None] * len(jobs)
+    errors = []
+
+    def run_pass(index, hosts, credential):
+        """Run one pass and store its result."""
+        kwargs = {'timeouts': timeouts}
+        if len(jobs) > 1:
+            kwargs.update(
+                inventory_path=_pass_path(PING_INVENTORY_PATH, index),
+                log_path=_pass_path(PING_LOG_PATH, index),
+                events_path=_pass_path(PING_EVENTS_PATH, index),
+                show_progress=False)
+        try:
+            results[index] = create_ping_inventory(
+                vault, vault_pass, hosts, profile_port, credential, forks,
+                ansible_verbosity, **kwargs)
+        except BaseException as ex:  # pylint: disable=broad-except
+            errors.append(ex)
+
+    threads = [threading.Thread(target=run_pass, args=(index,) + job)
+               for index, job in enumerate(jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    return results
+
+
+# A host's discovery cache record is dropped after this many discoveries
+# in a row fail to connect to it.
+DISCOVERY_CACHE_MAX_FAILURES = 3
+
+
+def load_discovery_cache(vault, path):
+    """Read a profile's discovery cache.
+
+    The cache maps each host to a record of its last discovery: the id
+    of the auth that worked ('auth_id'), the SSH port ('port'), when it
+    last worked ('last_success', seconds since the epoch), and how many
+    discoveries in a row have failed since ('failures').
+
+    :param vault: a Vault object
+    :param path: the path of the cache file
+    :returns: the cache, or an empty dict if there is no cache file yet
+    """
+    if not os.path.isfile(path):
+        return {}
+    return vault.load_as_json(path)
+
+
+def load_credential_stats(vault, path):
+    """Read a profile's credential statistics.
+
+    The statistics map each /24 network, as returned by subnet_key, to a
+    map from auth id to a [successes, attempts] pair. Only attempts that
+    reached the host count.
+
+    :param vault: a Vault object
+    :param path: the path of the statistics file
+    :returns: the statistics, or an empty dict if there is no file yet
+    """
+    if not os.path.isfile(path):
+        return {}
+    return vault.load_as_json(path)
+
+
+def is_fresh(record, now, ttl):
+    """Check whether a discovery cache record can be trusted as it is.
+
+    :param record: a discovery cache record
+    :param now: the current time, in seconds since the epoch
+    :param ttl: how long a record stays fresh, in seconds
+    :returns: True if the record's auth worked within the last ttl
+        seconds and hasn't failed since.
+    """
+    return ttl > 0 and record.get('failures', 0) == 0 and \
+        now - record.get('last_success', 0) <= ttl
+
+
+# pylint: disable=too-many-locals, too-many-branches
+def discover_hosts(vault, vault_pass, profile_ranges, profile_port,
+                   credentials, forks, ansible_verbosity,
+                   sessions_per_host=None, probe=True,
+                   unreachable_log=None, exclude_hosts=None,
+                   cache=None, cache_ttl=0, stats=None):
+    """Find which auths work with which hosts, trying auths concurrently.
+
+    Every host gets its own order of credentials to try, from
+    credential_order. In each round, every host is tried with its next
+    credential. The hosts are grouped by credential into one discovery
+    pass each, and all of the round's passes run at the same time. A
+    host is done as soon as a credential works with it, so it only waits
+    for the credentials it needs.
+
+    With a discovery cache, hosts with a fresh record are not contacted
+    at all. Hosts with a stale record are first tried with the auth that
+    last worked for them, and only go on to the other credentials if it
+    fails.
+
+    Addresses that turn out to belong to the same machine, by
+    host_identity, are collapsed into the first of them, so the machine
+    is only scanned once.
+
+    :param vault: a Vault object
+    :param vault_pass: password for the Vault
+    :param profile_ranges: hosts for the profile
+    :param profile_port: the SSH port to use
+    :param credentials: the auths to try, in the profile's order
+    :param forks: the number of Ansible forks to use for each pass
+    :param sessions_per_host: the most credentials to try against a
+        single host at the same time. Defaults to the
+        RHO_DISCOVERY_HOST_SESSIONS environment variable, or 1.
+    :param probe: whether to check for an SSH banner on every host before
+        running Ansible against it. Hosts that don't answer are skipped.
+    :param unreachable_log: a file to write unreachable hosts to, one
+        'host: reason' line each, or None.
+    :param exclude_hosts: host patterns to leave out of discovery, or None.
+    :param cache: a discovery cache, as returned by load_discovery_cache,
+        or None. It is updated in place with the results of discovery.
+    :param cache_ttl: how long a cache record is trusted without
+        contacting the host, in seconds. 0 means records are only used
+        to pick the auth to try first.
+    :param stats: credential statistics, as returned by
+        load_credential_stats, or None. They are used to order the
+        credentials for each host and are updated in place.
+
+    :returns: a tuple of
+      (list of hosts that worked for any auth,
+       map from hosts to SSH ports that worked with them,
+       map from hosts to lists of auths that worked with them,
+       list of hosts that failed with every auth,
+       the number of unreachable hosts,
+       map from hosts to the other addresses of the same machine
+      )
+    """
+    if sessions_per_host is None:
+        sessions_per_host = int(os.getenv('RHO_DISCOVERY_HOST_SESSIONS', 1))
+    sessions_per_host = max(1, min(sessions_per_host, len(credentials)))
+
+    success_hosts = []
+    success_port_map = {}
+    success_auth_map = defaultdict(list)
+    identity_map = {}
+    unreachable_count = [0]
+    if cache is None:
+        cache = {}
+    if stats is None:
+        stats = {}
+    now = time.time()
+    credentials_by_id = dict((credential.get('id'), credential)
+                             for credential in credentials)
+
+    def record_failure(host):
+        """Count a failed discovery in the host's cache record."""
+        record = cache.get(host)
+        if record is None:
+            return
+        record['failures'] = record.get('failures', 0) + 1
+        if record['failures'] >= DISCOVERY_CACHE_MAX_FAILURES:
+            del cache[host]
+
+    def record_unreachable(host, reason):
+        """Count an unreachable host and log it, if there is a log."""
+        unreachable_count[0] += 1
+        record_failure(host)
+        log.info('Skipping %s: %s.', host, reason)
+        if unreachable_log is not None:
+            unreachable_log.write(host + ': ' + reason + '\n')
+
+    def record_attempt(host, credential, worked):
+        """Count an attempt in the credential statistics."""
+        key = subnet_key(host)
+        if key is None:
+            return
+        counts = stats.setdefault(key, {}).setdefault(
+            credential.get('id'), [0, 0])
+        counts[0] += 1 if worked else 0
+        counts[1] += 1
+
+    def collect(result, credential, succeeded, retry):
+        """Add one pass's results to the running totals."""
+        success_, port_map_, auth_map_, failed_, unreachable_, \
+            identities_ = result
+        identity_map.update(identities_)
+        for host in success_:
+            succeeded.add(host)
+            success_port_map[host] = port_map_[host]
+            success_auth_map[host].extend(auth_map_[host])
+            record_attempt(host, credential, True)
+        for host in failed_:
+            record_attempt(host, credential, False)
+        retry.update(failed_)
+        # If credential used ssh keyfile then re-process
+        # unreachable systems due to issue #576
+        if credential.get('ssh_key_file'):
+            retry.update(unreachable_)
+
+    # Hosts whose cached auth worked recently enough are trusted without
+    # being contacted again, as long as they are still in the profile.
+    trusted = {}
+    for host, record in iteritems(cache):
+        credential = credentials_by_id.get(record.get('auth_id'))
+        if credential is not None and is_fresh(record, now, cache_ttl) \
+                and str(record.get('port')) == str(profile_port):
+            trusted[host] = (credential, record.get('port'))
+
+    def untrusted(profile_hosts):
+        """Take trusted hosts out of the stream of the profile's hosts."""
+        for host in profile_hosts:
+            if host not in trusted:
+                yield host
+            elif host not in success_auth_map:
+                credential, port = trusted[host]
+                if cache[host].get('identity'):
+                    identity_map[host] = cache[host]['identity']
+                success_hosts.append(host)
+                success_port_map[host] = port
+                success_auth_map[host].append(credential)
+
+    # Profiles saved by older versions may still hold overlapping
+    # ranges; candidate_hosts merges them first, which keeps those hosts
+    # from being probed more than once.
+    profile_hosts = untrusted(candidate_hosts(profile_ranges, exclude_hosts))
+
+    # Only hosts that will actually be pinged are held in memory. With
+    # the probe on, the profile's ranges are streamed through it in
+    # batches and only the hosts that answer are kept.
+    hosts = []
+    seen = set()
+    host_rtts = {}
+    if probe:
+        log.info('Checking for an SSH server on port %s.', profile_port)
+        print(_('Checking for an SSH server on port %s.') % profile_port)
+        for batch in batches(profile_hosts, PROBE_BATCH_SIZE):
+            live, skipped, rtts_ = probe_ssh_hosts(batch, profile_port)
+            host_rtts.update(rtts_)
+            for host in live:
+                if host not in seen:
+                    seen.add(host)
+                    hosts.append(host)
+            for host, reason in iteritems(skipped):
+                record_unreachable(host, reason)
+        print(_('Found %d systems with an SSH server; skipping %d '
+                'systems that did not answer.') %
+              (len(hosts), unreachable_count[0]))
+        print('')
+    else:
+        for host in profile_hosts:
+            if host not in seen:
+                seen.add(host)
+                hosts.append(host)
+    seen = None
+    timeouts = connect_timeouts(host_rtts)
+    host_rtts = None
+
+    if success_hosts:
+        log.info('Reusing cached discovery results for %d systems.',
+                 len(success_hosts))
+        print(_('Reusing cached discovery results for %d systems.') %
+              len(success_hosts))
+        print('')
+
+    # Hosts with a stale cache record are tried with the auth that last
+    # worked for them before anything else. Only the ones where it
+    # doesn't work anymore go on to the other credentials.
+    cached_groups = defaultdict(list)
+    uncached = []
+    for host in hosts:
+        record = cache.get(host, {})
+        if record.get('auth_id') in credentials_by_id:
+            cached_groups[record['auth_id']].append(host)
+        else:
+            uncached.append(host)
+    hosts = uncached
+
+    if cached_groups:
+        jobs = [(group, credentials_by_id[auth_id])
+                for auth_id, group in iteritems(cached_groups)]
+        log.info('Revalidating cached auths for %d systems.',
+                 sum(len(group) for group, _credential in jobs))
+        results = _run_discovery_passes(vault, vault_pass, jobs,
+                                        profile_port, forks,
+                                        ansible_verbosity, timeouts)
+        for (group, credential), result in zip(jobs, results):
+            succeeded = set()
+            retry = set()
+            collect(result, credential, succeeded, retry)
+            for host in group:
+                if host in succeeded:
+                    success_hosts.append(host)
+                elif host in retry:
+                    hosts.append(host)
+                else:
+                    record_unreachable(host, 'unreachable by Ansible')
+
+    orders = {}
+    for host_index, host in enumerate(hosts):
+        order = credential_order(host, host_index, credentials, stats)
+        tried = cache.get(host, {}).get('auth_id')
+        orders[host] = [index for index in order
+                        if credentials[index].get('id') != tried]
+
+    failed_hosts = []
+    round_num = 0
+    while hosts:
+        first = round_num * sessions_per_host
+        groups = defaultdict(list)
+        active = []
+        for host in hosts:
+            choices = orders[host][first:first + sessions_per_host]
+            if not choices:
+                failed_hosts.append(host)
+                continue
+            active.append(host)
+            for cred_index in choices:
+                groups[cred_index].append(host)
+        if not active:
+            break
+
+        jobs = [(groups[cred_index], credentials[cred_index])
+                for cred_index in sorted(groups)]
+        log.info('Discovery round %d running %d passes.',
+                 round_num + 1, len(jobs))
+        results = _run_discovery_passes(vault, vault_pass, jobs,
+                                        profile_port, forks,
+                                        ansible_verbosity, timeouts)
+
+        succeeded = set()
+        retry = set()
+        for (_group, credential), result in zip(jobs, results):
+            collect(result, credential, succeeded, retry)
+
+        hosts = []
+        for host in active:
+            if host in succeeded:
+                success_hosts.append(host)
+            elif host in retry:
+                hosts.append(host)
+            else:
+                record_unreachable(host, 'unreachable by Ansible')
+
+        round_num += 1
+    orders = None
+
+    for host in failed_hosts:
+        record_failure(host)
+    for host in success_hosts:
+        if host not in trusted:
+            cache[host] = {'auth_id': success_auth_map[host][0].get('id'),
+                           'port': success_port_map[host],
+                           'last_success': now,
+                           'failures': 0}
+            if host in identity_map:
+                cache[host]['identity'] = identity_map[host]
+
+    success_hosts, alias_map = collapse_aliases(success_hosts, identity_map)
+    if alias_map:
+        num_aliases = sum(len(aliases) for aliases in alias_map.values())
+        log.info('Found %d addresses of systems that are already being '
+                 'scanned: %s', num_aliases, alias_map)
+        print(_('Found %d addresses of systems that are already being '
+                'scanned at another address. Each system will only be '
+                'scanned once.') % num_aliases)
+        print('')
+
+    return success_hosts, success_port_map, success_auth_map, \
+        failed_hosts, unreachable_count[0], alias_map
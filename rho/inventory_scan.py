@@ -11,17 +11,23 @@
 
 from __future__ import print_function
 
+import collections
 import csv
+import heapq
 import json
+import math
+import multiprocessing
 import os.path
+import shutil
 import sys
 import tempfile
+import threading
 import time
 
-from rho import ansible_utils, postprocessing, utilities
+from rho import ansible_executor, ansible_utils, postprocessing, utilities
 from rho import vault as vault_module
 from rho.translation import _ as t
-from rho.utilities import str_to_ascii
+from rho.utilities import iteritems, str_to_ascii
 
 
 # Creates the filtered main inventory on which the custom
@@ -30,13 +36,19 @@ from rho.utilities import str_to_ascii
 # processed and the valid mapping as been figured out by
 # pinging.
 # pylint: disable=too-many-locals
-def make_inventory_dict(hosts, port_map, auth_map, group_size=10):
+def make_inventory_dict(hosts, port_map, auth_map, group_size=10,
+                        alias_map=None, scan_times=None):
     """Make the inventory for the scan, as a dict.
 
     :param hosts: a list of hosts for the inventory
     :param port_map: mapping from hosts to SSH ports
     :param auth_map: map from host IP to a list of auths it works with
-    :param group_size: write hosts in groups of this size
+    :param group_size: write hosts in groups of this size, on average
+    :param alias_map: map from hosts to the other addresses of the same
+        machine, which are reported in the connection.aliases fact
+    :param scan_times: the hosts' scan time history, from
+        load_scan_times. If there is any, the groups are balanced by
+        predicted scan time instead of having group_size hosts each.
 
     :returns: a dict with the structure:
 
@@ -66,35 +78,247 @@ def make_inventory_dict(hosts, port_map, auth_map, group_size=10):
                      'ansible_port': ascii_port}
         host_vars.update(
             ansible_utils.auth_as_ansible_host_vars(auth_map[host][0]))
+        if alias_map and alias_map.get(host):
+            host_vars['rho_aliases'] = str_to_ascii(
+                ','.join(alias_map[host]))
         host_dict[ascii_host] = host_vars
 
     result = {}
     keys = sorted(host_dict.keys())
-    for group_num in range((len(keys) + group_size - 1) // group_size):
-        start = group_num * group_size
+    num_groups = (len(keys) + group_size - 1) // group_size
+    if scan_times:
+        groups = balance_groups(keys, scan_times, num_groups)
+    else:
+        groups = [keys[start:start + group_size]
+                  for start in range(0, len(keys), group_size)]
+    for group_num, group_keys in enumerate(groups):
         group_name = 'group' + str(group_num)
         result[group_name] = {'hosts': {}}
-        for key in keys[start:start + group_size]:
+        for key in sorted(group_keys):
             result[group_name]['hosts'][key] = host_dict[key]
 
     return result
 
 
-def create_main_inventory(vault, hosts, port_map, auth_map, path):
+# A host's predicted scan time, in seconds, when nothing is known about
+# the scan times of any host.
+DEFAULT_HOST_SCAN_TIME = 60
+# How much a host's newest scan time counts in its history, against all
+# the ones before it.
+SCAN_TIME_WEIGHT = 0.5
+# A group's timeout is this many times the predicted scan time of its
+# slowest host.
+SCAN_TIMEOUT_FACTOR = 3
+
+
+def load_scan_times(vault, path):
+    """Read a profile's scan time history.
+
+    The history maps each host to a moving average of how long, in
+    seconds, its scans took.
+
+    :param vault: a Vault object
+    :param path: the path of the history file
+    :returns: the history, or an empty dict if there is no file yet
+    """
+    if not os.path.isfile(path):
+        return {}
+    return vault.load_as_json(path)
+
+
+def update_scan_times(scan_times, durations):
+    """Add the durations of a scan to the scan time history.
+
+    :param scan_times: the history, which is changed in place.
+    :param durations: a map from hosts to how long their scans took.
+    """
+    for host, duration in iteritems(durations):
+        if host in scan_times:
+            duration = SCAN_TIME_WEIGHT * duration + \
+                (1 - SCAN_TIME_WEIGHT) * scan_times[host]
+        scan_times[host] = round(duration, 1)
+
+
+def predicted_scan_times(hosts, scan_times):
+    """Predict how long each host's scan will take.
+
+    :param hosts: a list of hosts.
+    :param scan_times: the scan time history.
+    :returns: a map from hosts to seconds. Hosts without history get
+        the median of the hosts with history, or DEFAULT_HOST_SCAN_TIME.
+    """
+    known = sorted(scan_times[host] for host in hosts if host in scan_times)
+    default = known[len(known) // 2] if known else DEFAULT_HOST_SCAN_TIME
+    return dict((host, scan_times.get(host, default)) for host in hosts)
+
+
+def balance_groups(hosts, scan_times, num_groups):
+    """Split hosts into groups with about the same predicted scan time.
+
+    This is longest-processing-time-first scheduling: each host, slowest
+    first, goes to the group with the least predicted time so far. Slow
+    hosts end up in small groups of their own, so they don't make many
+    other hosts' group time out, and fast hosts share bigger groups.
+
+    :param hosts: a list of hosts.
+    :param scan_times: the scan time history.
+    :param num_groups: the number of groups to make.
+    :returns: a list of groups, each a list of hosts. The group with the
+        slowest host comes first.
+    """
+    predicted = predicted_scan_times(hosts, scan_times)
+    groups = [[] for _ in range(min(num_groups, len(hosts)))]
+    loads = [(0, index) for index in range(len(groups))]
+    for host in sorted(hosts, key=lambda host: (-predicted[host], host)):
+        load, index = heapq.heappop(loads)
+        groups[index].append(host)
+        heapq.heappush(loads, (load + predicted[host], index))
+    return groups
+
+
+def scan_timeout(hosts, forks, scan_times, default_minutes):
+    """Work out the timeout of a playbook run.
+
+    :param hosts: the hosts the run scans.
+    :param forks: the number of Ansible forks for the run.
+    :param scan_times: the scan time history.
+    :param default_minutes: the timeout per wave of forks when some of
+        the hosts have no history.
+    :returns: the timeout, in minutes.
+    """
+    waves = len(hosts) // int(forks) + 1
+    if not hosts or not all(host in scan_times for host in hosts):
+        return waves * default_minutes
+    slowest = max(scan_times[host] for host in hosts)
+    return waves * max(1, int(math.ceil(SCAN_TIMEOUT_FACTOR * slowest /
+                                        60.0)))
+
+
+class ScanTimer(object):
+    """Measure how long each host takes to scan, from a run's events.
+
+    Each host is charged the time from the start of a task to its result
+    for that task, so a host is not charged for waiting on slower hosts.
+    """
+
+    def __init__(self, clock=time.time):
+        """Create a ScanTimer.
+
+        :param clock: a function that returns the time, in seconds.
+        """
+        self.clock = clock
+        self.durations = {}
+        self.task_started = None
+        self.reported = set()
+
+    def handle(self, record):
+        """Account for one rho_events record."""
+        now = self.clock()
+        if record.get('status') == 'started':
+            self.task_started = now
+            self.reported = set()
+            return
+        host = record.get('host')
+        if host is None or self.task_started is None:
+            return
+        self.reported.add(host)
+        self.durations[host] = self.durations.get(host, 0) + \
+            now - self.task_started
+
+    def timed_out(self, hosts, timeout):
+        """Charge the hosts that were still working when a run timed out.
+
+        They are charged at least the timeout, so they get a bigger
+        share of a group to themselves next time.
+
+        :param hosts: the hosts of the run.
+        :param timeout: the run's timeout, in seconds.
+        :returns: the hosts that were still working.
+        """
+        stragglers = [host for host in hosts if host not in self.reported]
+        for host in stragglers:
+            self.durations[host] = max(self.durations.get(host, 0), timeout)
+        return stragglers
+
+
+# pylint: disable=too-many-arguments
+def create_main_inventory(vault, hosts, port_map, auth_map, path,
+                          alias_map=None, shards_path=None, scan_times=None):
     """Write an inventory file given the results of host discovery.
 
+    With shards_path, each group is written to its own encrypted file
+    in that directory, and path only gets an index of the groups, so a
+    scan of one group only has to decrypt that group.
+
     :param vault: an Ansible vault to encrypt the results.
     :param hosts: a list of hosts in the inventory.
     :param port_map: a mapping from hosts to SSH port numbers.
     :param auth_map: a mapping from hosts to SSH credentials.
-    :param path: the path to write the inventory.
+    :param path: the path to write the inventory, or its index.
+    :param alias_map: a mapping from hosts to the other addresses of the
+        same machine.
+    :param shards_path: the directory to write the groups to, or None to
+        write the whole inventory to path.
+    :param scan_times: the hosts' scan time history, to balance the
+        groups with.
     """
 
-    yml_dict = make_inventory_dict(hosts, port_map, auth_map)
-    vault.dump_as_yaml_to_file(yml_dict, path)
+    yml_dict = make_inventory_dict(hosts, port_map, auth_map,
+                                   alias_map=alias_map,
+                                   scan_times=scan_times)
+    if shards_path is None:
+        vault.dump_as_yaml_to_file(yml_dict, path)
+    else:
+        write_inventory_shards(vault, yml_dict, path, shards_path)
     ansible_utils.log_yaml_inventory('Main inventory', yml_dict)
 
 
+def shard_path(shards_path, group):
+    """Get the path of a group's inventory shard.
+
+    :param shards_path: the directory of shards.
+    :param group: the name of the group.
+    """
+    return os.path.join(shards_path, group + '.yml')
+
+
+def write_inventory_shards(vault, yml_dict, index_path, shards_path):
+    """Write an inventory as one encrypted file per group, plus an index.
+
+    Shards left over from an earlier inventory are removed, so the
+    directory can also be used as an inventory on its own.
+
+    :param vault: an Ansible vault to encrypt the files.
+    :param yml_dict: the inventory, from make_inventory_dict.
+    :param index_path: where to write the index, which maps each group
+        to the list of its hosts.
+    :param shards_path: the directory to write the groups to.
+    """
+    if not os.path.isdir(shards_path):
+        os.makedirs(shards_path)
+    for old_shard in os.listdir(shards_path):
+        os.remove(os.path.join(shards_path, old_shard))
+    for group, group_dict in yml_dict.items():
+        vault.dump_as_yaml_to_file({group: group_dict},
+                                   shard_path(shards_path, group))
+    vault.dump_as_yaml_to_file(hosts_by_group(yml_dict), index_path)
+
+
+def load_host_groups(vault, path):
+    """Read the groups of a scan inventory.
+
+    :param vault: an Ansible vault to decrypt the file.
+    :param path: an index written by write_inventory_shards, or a whole
+        inventory written by create_main_inventory without shards.
+    :returns: a pair of the groups, as returned by hosts_by_group, and
+        whether path is an index.
+    """
+    yml_dict = vault.load_as_yaml(path)
+    if all(isinstance(hosts, list) for hosts in yml_dict.values()):
+        return yml_dict, True
+    return hosts_by_group(yml_dict), False
+
+
 # We can't just pass the group names from create_main_inventory to
 # inventory_scan, because we might never call create_main_inventory if
 # we use --cache. So we have to read the groups from the inventory
@@ -240,12 +464,426 @@ def write_fact_report(facts_to_collect, facts_out, report_path):
             writer.writerow(data)
 
 
+def scan_concurrency(forks, group_size, cpus=None):
+    """Decide how many inventory groups to scan at the same time.
+
+    Each group's playbook run keeps up to one fork per host busy, so
+    enough groups run together to use all of the forks, but no more
+    than the controller has CPUs to drive them.
+
+    :param forks: the number of Ansible forks for the whole scan.
+    :param group_size: the number of hosts in the largest group.
+    :param cpus: the number of controller CPUs. Defaults to the number
+        this machine has.
+    :returns: the number of groups to keep in flight, at least 1.
+    """
+    if cpus is None:
+        try:
+            cpus = multiprocessing.cpu_count()
+        except NotImplementedError:
+            cpus = 1
+    return max(1, min(int(forks) // max(group_size, 1), cpus))
+
+
+def run_groups(groups, scan_group, concurrency):
+    """Scan inventory groups, keeping several in flight at once.
+
+    A new group starts as soon as one finishes. scan_group may return
+    more groups to scan, which are queued behind the others. If a group
+    raises an exception, no more groups are started, and once the ones
+    in flight are done the exception is raised again.
+
+    :param groups: a list of groups.
+    :param scan_group: called with each group to scan it. Returns a list
+        of further groups to scan, or None.
+    :param concurrency: the most groups to scan at the same time.
+    """
+    queue = collections.deque(groups)
+    errors = []
+    in_flight = [0]
+    condition = threading.Condition()
+
+    def worker():
+        """Scan groups until there are none left."""
+        while True:
+            with condition:
+                # A group in flight may still queue more.
+                while not queue and in_flight[0] and not errors:
+                    condition.wait()
+                if errors or not queue:
+                    return
+                group = queue.popleft()
+                in_flight[0] += 1
+            more = None
+            try:
+                more = scan_group(group)
+            except BaseException as ex:  # pylint: disable=broad-except
+                with condition:
+                    errors.append(ex)
+            with condition:
+                queue.extend(more or [])
+                in_flight[0] -= 1
+                condition.notify_all()
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+def split_timed_out(hosts, stragglers):
+    """Split the hosts of a scan that timed out, to retry them.
+
+    :param hosts: the hosts of the scan, more than one.
+    :param stragglers: the hosts that were still working when the scan
+        timed out.
+    :returns: two lists of hosts. If some hosts finished their last task
+        and some didn't, those are the two lists. Otherwise the hosts
+        are cut in half.
+    """
+    slow = [host for host in hosts if host in stragglers]
+    fast = [host for host in hosts if host not in stragglers]
+    if slow and fast:
+        return fast, slow
+    middle = len(hosts) // 2
+    return hosts[:middle], hosts[middle:]
+
+
+def _group_path(path, group):
+    """Get the per-group version of a log path.
+
+    :param path: a log path, like SCAN_LOG_PATH.
+    :param group: the name of an inventory group.
+    :returns: path, with the group inserted before the extension.
+    """
+    root, ext = os.path.splitext(path)
+    return '{0}-{1}{2}'.format(root, group, ext)
+
+
+# pylint: disable=too-many-arguments, too-many-locals, too-many-statements
+def scan_by_group(playbook, inventories, host_groups, vault_pass,
+                  facts_to_collect, scan_dirs, forks, env, log_path,
+                  verbosity, scan_times=None):
+    """Scan each group with its own playbook run.
+
+    Groups are scanned concurrently, as many at a time as
+    scan_concurrency allows, and each group's results are processed as
+    soon as it finishes. A group that times out is split in two and
+    both halves are retried, until the hosts that hang are scanned on
+    their own and skipped. The groups with the slowest predicted hosts
+    start first, and each group's timeout follows from its hosts'
+    predicted scan times.
+
+    :param playbook: the path to the scan playbook.
+    :param inventories: a map from each group to the inventory file to
+        scan it with.
+    :param host_groups: the inventory's groups, from hosts_by_group.
+    :param vault_pass: the vault password used to protect user data
+    :param facts_to_collect: a list of facts to collect.
+    :param scan_dirs: the directories on the remote host to scan.
+    :param forks: the number of Ansible forks.
+    :param env: the environment to run Ansible in.
+    :param log_path: path to log to. When groups run concurrently, each
+        logs to its own file next to it.
+    :param verbosity: number of v's of Ansible verbosity.
+    :param scan_times: the scan time history, from load_scan_times.
+    :returns: a list of per host fact dictionaries, in group order, and
+        a map from hosts to how long their scans took.
+    """
+    scan_times = scan_times or {}
+    variables_prefix = os.path.join(
+        tempfile.gettempdir(),
+        'rho-fact-temp-' + str(time.time()) + '-')
+
+    groups = list(host_groups.keys())
+    if scan_times:
+        predicted = predicted_scan_times(
+            [host for hosts in host_groups.values() for host in hosts],
+            scan_times)
+        groups.sort(key=lambda group: -max(
+            [predicted[host] for host in host_groups[group]] or [0]))
+    total_hosts_count = sum(len(hosts) for hosts in host_groups.values())
+    largest_group = max([len(hosts) for hosts in host_groups.values()] or
+                        [1])
+    concurrency = scan_concurrency(forks, largest_group)
+    group_forks = str(max(1, int(forks) // concurrency))
+    concurrent = concurrency > 1 and len(groups) > 1
+    rho_host_scan_timeout = int(os.getenv('RHO_HOST_SCAN_TIMEOUT', 10))
+
+    utilities.log.info('Starting scan of %d systems broken into %d groups, '
+                       '%d at a time.', total_hosts_count, len(groups),
+                       concurrency)
+    print('\nStarting scan of %d systems broken into %d groups, '
+          '%d at a time.' % (total_hosts_count, len(groups), concurrency))
+
+    lock = threading.Lock()
+    facts_by_host = {}
+    durations = {}
+    timed_out = []
+
+    def scan_group(item):
+        """Scan one group and process its results.
+
+        :param item: a tuple of the group's name, its hosts, the
+            inventory to scan it with, the host pattern to limit the
+            scan to, and the least timeout to give it, in minutes.
+        :returns: if the group timed out, the two halves to retry it as.
+        """
+        group, hosts, inventory, limit, least_timeout = item
+        variables_path = variables_prefix + group
+        group_log_path = _group_path(log_path, group) if concurrent \
+            else log_path
+        ansible_vars = {'facts_to_collect': list(facts_to_collect),
+                        'scan_dirs': ' '.join(scan_dirs or []),
+                        'variables_path': variables_path}
+
+        cmd_string = ('ansible-playbook {playbook} '
+                      '--limit {limit},localhost '
+                      '-i {inventory} -f {forks} '
+                      '--ask-vault-pass '
+                      '--extra-vars \'{vars}\'').format(
+                          limit=limit,
+                          playbook=playbook,
+                          inventory=inventory,
+                          forks=group_forks,
+                          vars=json.dumps(ansible_vars))
+
+        host_scan_timeout = max(least_timeout,
+                                scan_timeout(hosts, group_forks, scan_times,
+                                             rho_host_scan_timeout))
+        timer = ScanTimer()
+        utilities.log.info('Starting scan for group "%s" with %d systems'
+                           ' with timeout of %d minutes.',
+                           group, len(hosts), host_scan_timeout)
+        print('\nStarting scan for group "%s" with %d systems'
+              ' with timeout of %d minutes.\n' %
+              (group, len(hosts), host_scan_timeout))
+        try:
+            if ansible_executor.available():
+                # Concurrent runs would interleave Ansible's output, so
+                # they only report through the messages printed here.
+                ansible_executor.run_playbook(
+                    playbook, inventory, vault_pass,
+                    limit + ',localhost', ansible_vars, group_forks,
+                    ansible_verbosity=verbosity,
+                    quiet=concurrent,
+                    env=env,
+                    on_event=timer.handle,
+                    log_path=group_log_path,
+                    timeout=host_scan_timeout * 60)
+            else:
+                ansible_utils.run_with_vault(
+                    cmd_string, vault_pass,
+                    env=env,
+                    log_path=group_log_path,
+                    log_to_stdout=None if concurrent
+                    else utilities.process_host_scan,
+                    ansible_verbosity=verbosity,
+                    timeout=host_scan_timeout * 60,
+                    print_before_run=not concurrent)
+        except ansible_utils.AnsibleTimeoutException:
+            stragglers = timer.timed_out(hosts, host_scan_timeout * 60)
+            if len(hosts) == 1:
+                utilities.log.warning('Scan for host %s timed out after %d '
+                                      'minutes. It will be skipped.',
+                                      hosts[0], host_scan_timeout)
+                with lock:
+                    timed_out.extend(hosts)
+                return None
+            # Retry the hosts in two smaller groups, each with a fresh
+            # deadline, until the ones that hang are on their own.
+            halves = split_timed_out(hosts, stragglers)
+            utilities.log.warning('Scan for group "%s" timed out. Retrying '
+                                  'its hosts as groups of %d and %d.',
+                                  group, len(halves[0]), len(halves[1]))
+            return [('%s.%d' % (group, index), half, inventory,
+                     ','.join(half), host_scan_timeout)
+                    for index, half in enumerate(halves)]
+        finally:
+            with lock:
+                durations.update((host, timer.durations[host])
+                                 for host in hosts
+                                 if host in timer.durations)
+
+        if not os.path.isfile(variables_path):
+            utilities.log.error('Error collecting data for group %s.'
+                                'output file %s not found.',
+                                group, variables_path)
+            return None
+
+        with open(variables_path, 'r') as variables_file:
+            update_json = json.load(variables_file)
+        os.remove(variables_path)
+        with lock:
+            for host in hosts:
+                facts_by_host[host] = process_host_vars(
+                    facts_to_collect, {host: update_json.get(host, {})})
+            utilities.log.info('Processed scan data for %d more systems. '
+                               'Completed scanning %d systems.',
+                               len(hosts), len(facts_by_host))
+            print('\nProcessed scan data for %d more systems from group '
+                  '"%s". Completed scanning %d systems.\n' %
+                  (len(hosts), group, len(facts_by_host)))
+        return None
+
+    try:
+        run_groups([(group, host_groups[group], inventories[group], group, 0)
+                    for group in groups],
+                   scan_group, concurrency)
+    except ansible_utils.AnsibleProcessException as ex:
+        print(t("An error has occurred during the scan. Please review" +
+                " the output to resolve the given issue: %s" % str(ex)))
+        sys.exit(1)
+
+    if timed_out:
+        print(t('%d systems timed out and were skipped. See the log for '
+                'each of them.' % len(timed_out)))
+    facts_out = [facts for group in host_groups
+                 for host in host_groups[group]
+                 for facts in facts_by_host.get(host, [])]
+
+    return facts_out, durations
+
+
+# How often scan_in_one_run prints progress, in scanned hosts.
+REPORT_EVERY = 10
+
+# The name of the write_host role's task, which writes a host's results
+# to its own file as soon as the host is done.
+WRITE_HOST_TASK = "write the host's vars to its results file"
+
+
+# pylint: disable=too-many-arguments, too-many-locals
+def scan_in_one_run(playbook, inventory_path, host_groups, vault_pass,
+                    facts_to_collect, scan_dirs, forks, env, log_path,
+                    verbosity, scan_times=None):
+    """Scan every group with a single playbook run.
+
+    The playbook runs once over the whole inventory with the free
+    strategy, so the playbook and inventory are only loaded once and
+    each host moves through the roles at its own pace. Every host
+    writes its results to its own file when it is done, and they are
+    processed as they arrive. If the run times out, the hosts that
+    already finished are kept.
+
+    :param playbook: the path to the scan playbook.
+    :param inventory_path: path to the inventory to scan, a file or a
+        directory of shards.
+    :param host_groups: the inventory's groups, from hosts_by_group.
+    :param vault_pass: the vault password used to protect user data
+    :param facts_to_collect: a list of facts to collect.
+    :param scan_dirs: the directories on the remote host to scan.
+    :param forks: the number of Ansible forks.
+    :param env: the environment to run Ansible in.
+    :param log_path: path to log to.
+    :param verbosity: number of v's of Ansible verbosity.
+    :param scan_times: the scan time history, from load_scan_times.
+    :returns: a list of per host fact dictionaries, in inventory order,
+        and a map from hosts to how long their scans took.
+    """
+    results_dir = tempfile.mkdtemp(prefix='rho-facts-')
+    hosts = [host for group in host_groups for host in host_groups[group]]
+    ansible_vars = {'facts_to_collect': list(facts_to_collect),
+                    'scan_dirs': ' '.join(scan_dirs or []),
+                    'results_dir': results_dir,
+                    'rho_strategy': 'free'}
+    facts_by_host = {}
+
+    def collect(host):
+        """Process a host's results file, if it has written one."""
+        path = os.path.join(results_dir, host + '.json')
+        if host in facts_by_host or not os.path.isfile(path):
+            return
+        with open(path, 'r') as results_file:
+            host_vars = json.load(results_file)
+        os.remove(path)
+        facts_by_host[host] = process_host_vars(facts_to_collect,
+                                                {host: host_vars})
+        if len(facts_by_host) % REPORT_EVERY == 0:
+            print('Completed scanning %d of %d systems.' %
+                  (len(facts_by_host), len(hosts)))
+
+    timer = ScanTimer()
+
+    def on_event(record):
+        """Collect a host's results as soon as it writes them."""
+        timer.handle(record)
+        if record.get('status') == 'ok' and \
+                record.get('task', '').endswith(WRITE_HOST_TASK):
+            collect(record.get('host'))
+
+    rho_host_scan_timeout = int(os.getenv('RHO_HOST_SCAN_TIMEOUT', 10))
+    run_timeout = scan_timeout(hosts, forks, scan_times or {},
+                               rho_host_scan_timeout)
+    utilities.log.info('Starting scan of %d systems in one run with '
+                       'timeout of %d minutes.', len(hosts), run_timeout)
+    print('\nStarting scan of %d systems in one run with timeout of %d '
+          'minutes.\n' % (len(hosts), run_timeout))
+    try:
+        if ansible_executor.available():
+            ansible_executor.run_playbook(
+                playbook, inventory_path, vault_pass, None, ansible_vars,
+                forks, ansible_verbosity=verbosity, quiet=True, env=env,
+                on_event=on_event, log_path=log_path,
+                timeout=run_timeout * 60)
+        else:
+            cmd_string = ('ansible-playbook {playbook} '
+                          '-i {inventory} -f {forks} '
+                          '--ask-vault-pass '
+                          '--extra-vars \'{vars}\'').format(
+                              playbook=playbook,
+                              inventory=inventory_path,
+                              forks=forks,
+                              vars=json.dumps(ansible_vars))
+            ansible_utils.run_with_vault(
+                cmd_string, vault_pass,
+                env=env,
+                log_path=log_path,
+                log_to_stdout=utilities.process_host_scan,
+                ansible_verbosity=verbosity,
+                timeout=run_timeout * 60,
+                print_before_run=True)
+    except ansible_utils.AnsibleTimeoutException:
+        utilities.log.warning('Scan timed out. Systems that had not finished '
+                              'will be skipped.')
+        timer.timed_out([host for host in hosts if host not in facts_by_host],
+                        run_timeout * 60)
+    except ansible_utils.AnsibleProcessException as ex:
+        print(t("An error has occurred during the scan. Please review" +
+                " the output to resolve the given issue: %s" % str(ex)))
+        sys.exit(1)
+    finally:
+        for host in hosts:
+            collect(host)
+        shutil.rmtree(results_dir, ignore_errors=True)
+
+    missing = [host for host in hosts if host not in facts_by_host]
+    if missing:
+        utilities.log.warning('No scan results for hosts \n%s\nThey will be '
+                              'skipped.', missing)
+    print('Completed scanning %d systems.\n' % len(facts_by_host))
+    durations = dict((host, timer.durations[host]) for host in hosts
+                     if host in timer.durations)
+    return [facts for host in hosts
+            for facts in facts_by_host.get(host, [])], durations
+
+
 # pylint: disable=too-many-arguments, too-many-statements, too-many-branches
+# pylint: disable=too-many-locals
 def inventory_scan(hosts_yml_path, facts_to_collect, report_path,
                    vault_pass, base_name, forks=None,
-                   scan_dirs=None, log_path=None, verbosity=0):
+                   scan_dirs=None, log_path=None, verbosity=0,
+                   single_run=False):
     """Run an inventory scan.
 
+    Groups are scanned by scan_by_group, or with single_run, all at
+    once by scan_in_one_run.
+
     :param hosts_yml_path: path to an Ansible inventory file to scan.
     :param facts_to_collect: a list of facts to collect.
     :param report_path: the path to write a report to.
@@ -256,6 +894,7 @@ def inventory_scan(hosts_yml_path, facts_to_collect, report_path,
         default.
     :param log_path: path to log to, or None for default.
     :param verbosity: number of v's of Ansible verbosity.
+    :param single_run: whether to scan every group in one playbook run.
 
     :returns: True if scan completed successfully, False if not.
     """
@@ -263,12 +902,18 @@ def inventory_scan(hosts_yml_path, facts_to_collect, report_path,
     hosts_yml_path = utilities.get_config_path(hosts_yml)
 
     vault = vault_module.Vault(vault_pass)
-    hosts_dict = vault.load_as_yaml(hosts_yml_path)
-    host_groups = hosts_by_group(hosts_dict)
-
-    variables_prefix = os.path.join(
-        tempfile.gettempdir(),
-        'rho-fact-temp-' + str(time.time()) + '-')
+    host_groups, sharded = load_host_groups(vault, hosts_yml_path)
+    # Each run only decrypts the shards of the groups it scans. An
+    # inventory written before shards existed is scanned whole.
+    if sharded:
+        shards_path = utilities.get_config_path(
+            base_name + utilities.PROFILE_HOSTS_SHARDS_SUFFIX)
+        inventory_path = shards_path
+        inventories = dict((group, shard_path(shards_path, group))
+                           for group in host_groups)
+    else:
+        inventory_path = hosts_yml_path
+        inventories = dict((group, hosts_yml_path) for group in host_groups)
 
     if os.path.isfile(utilities.PLAYBOOK_DEV_PATH):
         playbook = utilities.PLAYBOOK_DEV_PATH
@@ -285,86 +930,25 @@ def inventory_scan(hosts_yml_path, facts_to_collect, report_path,
     my_env["ANSIBLE_HOST_KEY_CHECKING"] = "False"
     my_env["ANSIBLE_NOCOLOR"] = "True"
 
-    facts_out = []
-    total_hosts_count = 0
-    for group in host_groups.keys():
-        hosts = host_groups.get(group, [])
-        total_hosts_count += len(hosts)
-
-    utilities.log.info('Starting scan of %d systems broken into %d groups.',
-                       total_hosts_count, len(host_groups.keys()))
-    print('\nStarting scan of %d systems broken into %d groups.' %
-          (total_hosts_count, len(host_groups.keys())))
-    for group in host_groups.keys():
-        variables_path = variables_prefix + group
-        hosts = host_groups.get(group, [])
-        ansible_vars = {'facts_to_collect': list(facts_to_collect),
-                        'scan_dirs': ' '.join(scan_dirs or []),
-                        'variables_path': variables_path}
-
-        cmd_string = ('ansible-playbook {playbook} '
-                      '--limit {group},localhost '
-                      '-i {inventory} -f {forks} '
-                      '--ask-vault-pass '
-                      '--extra-vars \'{vars}\'').format(
-                          group=group,
-                          playbook=playbook,
-                          inventory=hosts_yml_path,
-                          forks=forks,
-                          vars=json.dumps(ansible_vars))
-
-        rho_host_scan_timeout = os.getenv('RHO_HOST_SCAN_TIMEOUT', 10)
-        host_scan_timeout = ((len(hosts) // int(forks)) + 1) \
-            * rho_host_scan_timeout
-        utilities.log.info('Starting scan for group "%s" with %d systems'
-                           ' with timeout of %d minutes.',
-                           group, len(hosts), host_scan_timeout)
-        print('\nStarting scan for group "%s" with %d systems'
-              ' with timeout of %d minutes.\n' %
-              (group, len(hosts), host_scan_timeout))
-        try:
-            ansible_utils.run_with_vault(
-                cmd_string, vault_pass,
-                env=my_env,
-                log_path=log_path,
-                log_to_stdout=utilities.process_host_scan,
-                ansible_verbosity=verbosity,
-                timeout=host_scan_timeout * 60,
-                print_before_run=True)
-        except ansible_utils.AnsibleProcessException as ex:
-            print(t("An error has occurred during the scan. Please review" +
-                    " the output to resolve the given issue: %s" % str(ex)))
-            sys.exit(1)
-        except ansible_utils.AnsibleTimeoutException as ex:
-            utilities.log.warning('Scan for group "%s" timed out. Hosts \n'
-                                  '%s\nwill be skipped. The rest of the scan '
-                                  'is not affected.',
-                                  group, host_groups[group])
-            continue
-
-        if os.path.isfile(variables_path):
-            with open(variables_path, 'r') as variables_file:
-                vars_by_host = {}
-                update_json = json.load(variables_file)
-                for host in hosts:
-                    host_facts = update_json.get(host, {})
-                    vars_by_host[host] = host_facts
-                os.remove(variables_path)
-                utilities.log.info('Processing scan data for %d more systems.',
-                                   len(hosts))
-                print('\nProcessing scan data for %d more systems.' %
-                      (len(hosts)))
-                group_facts = process_host_vars(facts_to_collect, vars_by_host)
-                facts_out += group_facts
-                utilities.log.info('Completed scanning %d systems.',
-                                   len(facts_out))
-                print('Completed scanning %d systems.\n' %
-                      (len(facts_out)))
+    scan_times_path = utilities.get_config_path(
+        base_name + utilities.PROFILE_SCAN_TIMES_SUFFIX)
+    scan_times = load_scan_times(vault, scan_times_path)
 
-        else:
-            utilities.log.error('Error collecting data for group %s.'
-                                'output file %s not found.',
-                                group, variables_path)
+    forks = forks or '50'
+    if single_run:
+        facts_out, durations = scan_in_one_run(
+            playbook, inventory_path, host_groups, vault_pass,
+            facts_to_collect, scan_dirs, forks, my_env, log_path, verbosity,
+            scan_times=scan_times)
+    else:
+        facts_out, durations = scan_by_group(
+            playbook, inventories, host_groups, vault_pass,
+            facts_to_collect, scan_dirs, forks, my_env, log_path, verbosity,
+            scan_times=scan_times)
+
+    if durations:
+        update_scan_times(scan_times, durations)
+        vault.dump_as_json_to_file(scan_times, scan_times_path)
 
     if facts_out == []:
         print(t("An error has occurred during the scan. " +
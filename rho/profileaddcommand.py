@@ -21,7 +21,7 @@ from collections import OrderedDict
 from rho import utilities
 from rho.clicommand import CliCommand
 from rho.vault import get_vault
-from rho.utilities import multi_arg, read_ranges
+from rho.utilities import multi_arg, normalize_ranges, read_ranges
 from rho.translation import _
 
 
@@ -77,6 +77,11 @@ class ProfileAddCommand(CliCommand):
                                metavar="HOSTS", default=[],
                                help=_("IP range to scan."
                                       " See 'man rho' for supported formats."))
+        self.parser.add_option("--exclude-hosts", dest="exclude_hosts",
+                               action="callback", callback=multi_arg,
+                               metavar="EXCLUDE_HOSTS", default=[],
+                               help=_("IP range to leave out of the scan."
+                                      " See 'man rho' for supported formats."))
         self.parser.add_option("--sshport", dest="sshport", metavar="SSHPORT",
                                help=_("SSHPORT for connection; default=22"))
         self.parser.add_option("--auth", dest="auth", metavar="AUTH",
@@ -128,7 +133,7 @@ class ProfileAddCommand(CliCommand):
                 print(_("Profile '%s' already exists.") % self.options.name)
                 sys.exit(1)
 
-        range_list = read_ranges(self.options.hosts)
+        range_list = normalize_ranges(read_ranges(self.options.hosts))
 
         if not os.path.isfile(utilities.CREDENTIALS_PATH):
             print(_('No credentials exist yet.'))
@@ -155,6 +160,9 @@ class ProfileAddCommand(CliCommand):
                                    ("hosts", range_list),
                                    ("ssh_port", str(ssh_port)),
                                    ("auth", creds)])
+        if self.options.exclude_hosts:
+            new_profile['exclude_hosts'] = normalize_ranges(
+                read_ranges(self.options.exclude_hosts))
 
         _save_profile(vault, new_profile, profiles_list)
         print(_('Profile "%s" was added' % self.options.name))
@@ -16,6 +16,7 @@ either individually or all profiles
 
 from __future__ import print_function
 import os
+import shutil
 import sys
 import glob
 from rho import utilities
@@ -23,11 +24,21 @@ from rho.clicommand import CliCommand
 from rho.vault import get_vault
 from rho.utilities import (
     PROFILE_HOSTS_SUFIX,
+    PROFILE_HOSTS_SHARDS_SUFFIX,
     PROFILE_HOST_AUTH_MAPPING_SUFFIX,
+    PROFILE_DISCOVERY_CACHE_SUFFIX,
+    PROFILE_CREDENTIAL_STATS_SUFFIX,
+    PROFILE_SCAN_TIMES_SUFFIX,
     get_config_path,
 )
 from rho.translation import _
 
+# What discovery and scans have learned about a profile's hosts is
+# removed with it.
+DISCOVERY_DATA_SUFFIXES = [PROFILE_DISCOVERY_CACHE_SUFFIX,
+                           PROFILE_CREDENTIAL_STATS_SUFFIX,
+                           PROFILE_SCAN_TIMES_SUFFIX]
+
 
 def _backup_host_auth_mapping(profile):
     """Backup the ``profile`` host auth mapping file.
@@ -114,6 +125,13 @@ class ProfileClearCommand(CliCommand):
             profile_hosts_path = get_config_path(profile + PROFILE_HOSTS_SUFIX)
             if os.path.isfile(profile_hosts_path):
                 os.remove(profile_hosts_path)
+            shutil.rmtree(get_config_path(profile +
+                                          PROFILE_HOSTS_SHARDS_SUFFIX),
+                          ignore_errors=True)
+            for suffix in DISCOVERY_DATA_SUFFIXES:
+                data_path = get_config_path(profile + suffix)
+                if os.path.isfile(data_path):
+                    os.remove(data_path)
             _backup_host_auth_mapping(profile)
 
         # removes all inventories ever.
@@ -125,4 +143,10 @@ class ProfileClearCommand(CliCommand):
                 file_list = os.path.basename(file_list)
                 profile = file_list[:file_list.rfind(PROFILE_HOSTS_SUFIX)]
                 _backup_host_auth_mapping(profile)
+            for shards_path in glob.glob(
+                    get_config_path('*' + PROFILE_HOSTS_SHARDS_SUFFIX)):
+                shutil.rmtree(shards_path, ignore_errors=True)
+            for suffix in DISCOVERY_DATA_SUFFIXES:
+                for data_path in glob.glob(get_config_path('*' + suffix)):
+                    os.remove(data_path)
             print(_("All network profiles removed"))
@@ -20,7 +20,7 @@ import sys
 from rho import utilities
 from rho.clicommand import CliCommand
 from rho.vault import get_vault
-from rho.utilities import multi_arg, read_ranges
+from rho.utilities import multi_arg, normalize_ranges, read_ranges
 from rho.translation import _
 
 
@@ -45,6 +45,11 @@ class ProfileEditCommand(CliCommand):
                                metavar="RANGE", default=[],
                                help=_("IP range to scan. See "
                                       "'man rho' for supported formats."))
+        self.parser.add_option("--exclude-hosts", dest="exclude_hosts",
+                               action="callback", callback=multi_arg,
+                               metavar="EXCLUDE_RANGE", default=[],
+                               help=_("IP range to leave out of the scan. "
+                                      "See 'man rho' for supported formats."))
         self.parser.add_option("--sshport", dest="sshport", metavar="SSHPORT",
                                help=_("SSHPORT for connection; default=22"))
         # can only replace auth
@@ -66,8 +71,9 @@ class ProfileEditCommand(CliCommand):
             sys.exit(1)
 
         if not self.options.hosts and not self.options.auth \
-           and not self.options.sshport:
-            print(_("Specify either hosts, sshport, or auths to update."))
+           and not self.options.sshport and not self.options.exclude_hosts:
+            print(_("Specify either hosts, exclude hosts, sshport, or auths "
+                    "to update."))
             self.parser.print_help()
             sys.exit(1)
 
@@ -89,6 +95,7 @@ class ProfileEditCommand(CliCommand):
         cred_list = []
         profiles_list = []
         range_list = []
+        exclude_list = []
         profile_found = False
         auth_found = False
 
@@ -104,7 +111,11 @@ class ProfileEditCommand(CliCommand):
         profiles_list = vault.load_as_json(utilities.PROFILES_PATH)
 
         if self.options.hosts:
-            range_list = read_ranges(self.options.hosts)
+            range_list = normalize_ranges(read_ranges(self.options.hosts))
+
+        if self.options.exclude_hosts:
+            exclude_list = normalize_ranges(
+                read_ranges(self.options.exclude_hosts))
 
         for curr_profile in profiles_list:
             if curr_profile.get('name') == self.options.name:
@@ -112,6 +123,9 @@ class ProfileEditCommand(CliCommand):
                 if self.options.hosts:
                     curr_profile['hosts'] = range_list
 
+                if self.options.exclude_hosts:
+                    curr_profile['exclude_hosts'] = exclude_list
+
                 if self.options.sshport:
                     curr_profile['ssh_port'] = str(self.options.sshport)
 
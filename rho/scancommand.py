@@ -25,7 +25,11 @@ from rho.vault import get_vault_and_password
 from rho.utilities import (
     multi_arg, _read_in_file, iteritems,
     PROFILE_HOSTS_SUFIX,
+    PROFILE_HOSTS_SHARDS_SUFFIX,
     PROFILE_HOST_AUTH_MAPPING_SUFFIX,
+    PROFILE_DISCOVERY_CACHE_SUFFIX,
+    PROFILE_CREDENTIAL_STATS_SUFFIX,
+    PROFILE_SCAN_TIMES_SUFFIX,
     log
 )
 from rho import host_discovery
@@ -114,6 +118,23 @@ class ScanCommand(CliCommand):
                                callback=multi_arg, default=[],
                                help=_("list of remote directories to scan"))
 
+        self.parser.add_option("--skip-ssh-probe", dest="skip_ssh_probe",
+                               action="store_true", default=False,
+                               help=_("Run discovery against every host "
+                                      "instead of only hosts that answer "
+                                      "on the SSH port"))
+
+        self.parser.add_option("--discovery-ttl", dest="discovery_ttl",
+                               metavar="HOURS", default='0',
+                               help=_("Reuse the auth found for a host by a "
+                                      "discovery in the last HOURS hours "
+                                      "without connecting to it; default=0"))
+
+        self.parser.add_option("--single-run", dest="single_run",
+                               action="store_true", default=False,
+                               help=_("Scan all systems with one Ansible "
+                                      "run instead of one run per group"))
+
         self.parser.add_option("--ansible-forks", dest="ansible_forks",
                                metavar="FORKS",
                                help=_("number of ansible forks"))
@@ -152,6 +173,17 @@ class ScanCommand(CliCommand):
                 self.parser.print_help()
                 sys.exit(1)
 
+        try:
+            if float(self.options.discovery_ttl) < 0:
+                print(_("--discovery-ttl can only be a non-negative "
+                        "number."))
+                self.parser.print_help()
+                sys.exit(1)
+        except ValueError:
+            print(_("--discovery-ttl can only be a non-negative number."))
+            self.parser.print_help()
+            sys.exit(1)
+
         # perform fact validation
         input_facts = self.options.facts
         assert isinstance(input_facts, list)
@@ -184,6 +216,7 @@ class ScanCommand(CliCommand):
         profile_found = False
         profile_auth_list = []
         profile_ranges = []
+        profile_exclude_ranges = []
         profile_port = 22
         profile = self.options.profile
         forks = self.options.ansible_forks \
@@ -208,6 +241,7 @@ class ScanCommand(CliCommand):
             if self.options.profile == curr_profile.get('name'):
                 profile_found = True
                 profile_ranges = curr_profile.get('hosts')
+                profile_exclude_ranges = curr_profile.get('exclude_hosts', [])
                 profile_auths = curr_profile.get('auth')
                 profile_port = curr_profile.get('ssh_port')
                 cred_list = vault.load_as_json(utilities.CREDENTIALS_PATH)
@@ -232,11 +266,6 @@ class ScanCommand(CliCommand):
         # cache is used when the profile/auth mapping has been previously
         # used and does not need to be rerun.
         if not self.options.cache:
-            success_hosts = []
-            unreachalbe_hosts = []
-            success_port_map = {}
-            auth_map = {}
-            remaining_hosts = profile_ranges
             cred_names = [cred.get('name') for cred in profile_auth_list]
             creds_str = ', '.join(cred_names)
             log.info('Connection discovery will be perform with the following'
@@ -246,37 +275,44 @@ class ScanCommand(CliCommand):
             print(_('Note: Any ssh-agent connection setup for a target host '
                     'will be used as a fallback if it exists.'))
             print()
-            for cred_item in profile_auth_list:
-                log.info('Discovery starting with credential %s.',
-                         cred_item.get('name'))
-                success_hosts_, success_port_map_, \
-                    auth_map_, remaining_hosts_, unreachalbe_hosts_ = \
-                    host_discovery.create_ping_inventory(
+            discovery_cache_path = utilities.get_config_path(
+                profile + PROFILE_DISCOVERY_CACHE_SUFFIX)
+            discovery_cache = host_discovery.load_discovery_cache(
+                vault, discovery_cache_path)
+            credential_stats_path = utilities.get_config_path(
+                profile + PROFILE_CREDENTIAL_STATS_SUFFIX)
+            credential_stats = host_discovery.load_credential_stats(
+                vault, credential_stats_path)
+            with NamedTemporaryFile(mode='w',
+                                    delete=False) as unreachable_temp:
+                success_hosts, success_port_map, auth_map, \
+                    remaining_hosts, num_unreachable, alias_map = \
+                    host_discovery.discover_hosts(
                         vault, vault_pass,
-                        remaining_hosts,
+                        profile_ranges,
                         profile_port,
-                        cred_item, forks,
-                        self.verbosity)
-                success_hosts = success_hosts + success_hosts_
-                remaining_hosts = remaining_hosts_
-                unreachalbe_hosts = unreachalbe_hosts_
-                # If credential used ssh keyfile then re-process unreachable
-                # systems due to issue #576
-                if cred_item.get('ssh_key_file'):
-                    remaining_hosts = remaining_hosts_ + unreachalbe_hosts_
-
-                success_port_map.update(success_port_map_)
-                auth_map.update(auth_map_)
-                log.info('Discovery with credential %s completed.',
-                         cred_item.get('name'))
+                        profile_auth_list, forks,
+                        self.verbosity,
+                        probe=not self.options.skip_ssh_probe,
+                        unreachable_log=unreachable_temp,
+                        exclude_hosts=profile_exclude_ranges,
+                        cache=discovery_cache,
+                        cache_ttl=float(self.options.discovery_ttl) * 3600,
+                        stats=credential_stats)
+            vault.dump_as_json_to_file(discovery_cache, discovery_cache_path)
+            vault.dump_as_json_to_file(credential_stats,
+                                       credential_stats_path)
+            log.info('Discovery completed with %d credentials.',
+                     len(profile_auth_list))
             if not success_hosts:
                 print(_('All auths are invalid for this profile'))
                 sys.exit(1)
 
             num_success = len(success_hosts)
             num_failed = len(remaining_hosts)
-            num_unreachable = len(unreachalbe_hosts)
-            num_total = num_success + num_failed + num_unreachable
+            num_aliases = sum(len(aliases) for aliases in alias_map.values())
+            num_total = num_success + num_aliases + num_failed + \
+                num_unreachable
             if num_failed > 0:
                 with NamedTemporaryFile(mode='w', delete=False) as failed_temp:
                     for failed in remaining_hosts:
@@ -290,6 +326,14 @@ class ScanCommand(CliCommand):
                     print(_('Failed to connect to the following systems: %s.'
                             % (failed_hosts)))
                 print()
+            if num_unreachable > 0:
+                print(_('%d systems were unreachable. See the following '
+                        'file "%s" for a list of the unreachable systems '
+                        'and the reason for each.' %
+                        (num_unreachable, unreachable_temp.name)))
+                print()
+            else:
+                os.remove(unreachable_temp.name)
 
             log.info('Scan will be performed against %d of %d systems.',
                      num_success, num_total)
@@ -299,9 +343,14 @@ class ScanCommand(CliCommand):
 
             _create_hosts_auths_file(auth_map, profile)
 
-            inventory_scan.create_main_inventory(vault, success_hosts,
-                                                 success_port_map, auth_map,
-                                                 hosts_yml_path)
+            inventory_scan.create_main_inventory(
+                vault, success_hosts, success_port_map, auth_map,
+                hosts_yml_path, alias_map=alias_map,
+                shards_path=utilities.get_config_path(
+                    profile + PROFILE_HOSTS_SHARDS_SUFFIX),
+                scan_times=inventory_scan.load_scan_times(
+                    vault, utilities.get_config_path(
+                        profile + PROFILE_SCAN_TIMES_SUFFIX)))
 
         elif os.path.isfile(hosts_yml_path) is False:
             print("Profile '" + profile + "' has not been processed. " +
@@ -313,7 +362,8 @@ class ScanCommand(CliCommand):
             hosts_yml_path, self.facts_to_collect, report_path, vault_pass,
             profile, forks=forks, scan_dirs=self.options.scan_dirs,
             log_path=self.options.logfile,
-            verbosity=self.verbosity)
+            verbosity=self.verbosity,
+            single_run=self.options.single_run)
 
         host_auth_mapping = \
             self.options.profile + PROFILE_HOST_AUTH_MAPPING_SUFFIX
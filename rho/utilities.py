@@ -12,13 +12,13 @@
 
 from __future__ import print_function
 import csv
+import itertools
 import logging
 import os
 import re
 import sys
 import tempfile
 from shutil import move
-from datetime import datetime
 import sh
 from xdg.BaseDirectory import xdg_data_home, xdg_config_home
 from rho.translation import _
@@ -32,11 +32,16 @@ PROFILES_PATH = os.path.join(CONFIG_DIR, 'profiles')
 PING_INVENTORY_PATH = os.path.join(CONFIG_DIR, 'ping-inventory.yml')
 RHO_LOG = os.path.join(DATA_DIR, 'rho_log')
 PING_LOG_PATH = os.path.join(DATA_DIR, 'ping_log')
+PING_EVENTS_PATH = os.path.join(DATA_DIR, 'ping_events')
 ANSIBLE_LOG_PATH = os.path.join(DATA_DIR, 'ansible_log')
 SCAN_LOG_PATH = os.path.join(DATA_DIR, 'scan_log')
 
 PROFILE_HOSTS_SUFIX = '_hosts.yml'
+PROFILE_HOSTS_SHARDS_SUFFIX = '_hosts.d'
 PROFILE_HOST_AUTH_MAPPING_SUFFIX = '_host_auth_mapping'
+PROFILE_DISCOVERY_CACHE_SUFFIX = '_discovery_cache'
+PROFILE_CREDENTIAL_STATS_SUFFIX = '_credential_stats'
+PROFILE_SCAN_TIMES_SUFFIX = '_scan_times'
 
 PLAYBOOK_DEV_PATH = 'rho_playbook.yml'
 PLAYBOOK_RPM_PATH = '/usr/share/ansible/rho/rho_playbook.yml'
@@ -85,60 +90,6 @@ def setup_logging(verbosity):
     log.addHandler(stderr_handler)
 
 
-def process_discovery_scan(line):
-    """Process the output of a discovery scan.
-
-    :param line: a line from the discovery scan_log
-    """
-    log_path = os.environ.get('RHO_ANSIBLE_LOG', None)
-    rho_cred = os.environ.get('RHO_CREDENTIAL_NAME', '')
-    hosts_processed = int(os.environ.get('RHO_HOST_PROCESSED', '0'))
-    hosts_successful = int(os.environ.get('RHO_HOST_SUCCESSFUL', '0'))
-    hosts_unreachable = int(os.environ.get('RHO_HOST_UNREACHABLE', '0'))
-    hosts_failed = int(os.environ.get('RHO_HOST_FAILED', '0'))
-
-    print_status = False
-    line = line.strip('\n')
-    if 'SUCCESS' in line:
-        hosts_successful += 1
-        hosts_processed += 1
-        os.environ['RHO_HOST_SUCCESSFUL'] = str(hosts_successful)
-        os.environ['RHO_HOST_PROCESSED'] = str(hosts_processed)
-        print_status = True
-    elif 'FAILED' in line:
-        hosts_failed += 1
-        hosts_processed += 1
-        os.environ['RHO_HOST_FAILED'] = str(hosts_failed)
-        os.environ['RHO_HOST_PROCESSED'] = str(hosts_processed)
-        print_status = True
-    elif 'UNREACHABLE' in line:
-        hosts_unreachable += 1
-        hosts_processed += 1
-        os.environ['RHO_HOST_UNREACHABLE'] = str(hosts_unreachable)
-        os.environ['RHO_HOST_PROCESSED'] = str(hosts_processed)
-        print_status = True
-
-    # Display every 5 processed
-    if hosts_processed % 5 == 0 and print_status:
-        if log_path is not None:
-            with open(log_path, 'ab') as logfile:
-                logfile.write('******* %s *******' %
-                              (str(datetime.now()).encode('utf-8')))
-                logfile.flush()
-        print(_('%d hosts processed with credential %s. ' %
-                (hosts_processed, rho_cred)))
-        if hosts_successful > 0:
-            print(_('%d hosts connected successfully with '
-                    'credential %s.' % (hosts_successful, rho_cred)))
-        if hosts_failed > 0:
-            print(_('%d hosts failed to connect with '
-                    'credential %s.' % (hosts_failed, rho_cred)))
-        if hosts_unreachable > 0:
-            print(_('%d hosts were unreachable.' % hosts_unreachable))
-
-        print('\n')
-
-
 def process_host_scan(line):
     """Process the output of a discovery scan.
 
@@ -374,6 +325,268 @@ def read_ranges(ranges_or_path):
     return normalized_hosts
 
 
+# Profiles with patterns like '[0:255].[0:255].[0:255].1' would turn
+# into millions of one-address intervals. Leave those as they are.
+MAX_PATTERN_INTERVALS = 65536
+FULL_OCTET = (0, 255)
+
+
+def _parse_ip_pattern(pattern):
+    """Parse an IP address pattern into one (low, high) pair per octet.
+
+    :param pattern: a host pattern, like '10.0.[1:20].5'
+    :returns: a list of four (low, high) tuples, or None if pattern is not
+        an IPv4 address pattern.
+    """
+    octets = pattern.split('.')
+    if len(octets) != 4:
+        return None
+
+    result = []
+    for octet in octets:
+        match = re.match(r'^(?:([0-9]{1,3})|\[([0-9]{1,3}):([0-9]{1,3})\])$',
+                         octet)
+        if match is None:
+            return None
+        if match.group(1) is not None:
+            low = high = int(match.group(1))
+        else:
+            low, high = int(match.group(2)), int(match.group(3))
+        if low > high or high > 255:
+            return None
+        result.append((low, high))
+    return result
+
+
+def _octets_to_int(octets):
+    value = 0
+    for octet in octets:
+        value = (value << 8) | octet
+    return value
+
+
+def _int_to_octets(value):
+    return [(value >> shift) & 255 for shift in (24, 16, 8, 0)]
+
+
+def _pattern_interval_count(octet_ranges):
+    """Count the intervals _pattern_intervals would generate."""
+    split = 3
+    while split > 0 and octet_ranges[split] == FULL_OCTET:
+        split -= 1
+    count = 1
+    for low, high in octet_ranges[:split]:
+        count *= high - low + 1
+    return count
+
+
+def _pattern_intervals(octet_ranges):
+    """Generate the address intervals covered by a parsed IP pattern.
+
+    Everything after the last octet that isn't the full [0:255] range
+    is contiguous, so '10.[0:1].[0:255].[0:255]' is one interval but
+    '10.0.[1:3].5' is three.
+
+    :param octet_ranges: the result of _parse_ip_pattern
+    :returns: a generator of (first, last) integer addresses
+    """
+    split = 3
+    while split > 0 and octet_ranges[split] == FULL_OCTET:
+        split -= 1
+    prefixes = itertools.product(*[range(low, high + 1)
+                                   for low, high in octet_ranges[:split]])
+    low, high = octet_ranges[split]
+    rest = 3 - split
+    for prefix in prefixes:
+        yield (_octets_to_int(list(prefix) + [low] + [0] * rest),
+               _octets_to_int(list(prefix) + [high] + [255] * rest))
+
+
+def merge_intervals(intervals):
+    """Merge overlapping and adjacent integer intervals.
+
+    :param intervals: an iterable of (first, last) pairs, inclusive.
+    :returns: a sorted list of disjoint, non-adjacent (first, last) pairs.
+    """
+    merged = []
+    for first, last in sorted(intervals):
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def _span_patterns(low, high, depth=0):
+    """Cover an address interval exactly with octet-range patterns.
+
+    :param low: the first address of the interval, as a list of octets.
+    :param high: the last address of the interval, as a list of octets.
+    :param depth: the first octet where low and high may differ.
+    :returns: a list of patterns, each a list of four (low, high) pairs.
+    """
+    prefix = [(octet, octet) for octet in low[:depth]]
+    if depth == 3:
+        return [prefix + [(low[3], high[3])]]
+    if low[depth] == high[depth]:
+        return _span_patterns(low, high, depth + 1)
+
+    rest = 3 - depth
+    first, last = low[depth], high[depth]
+    head, tail = [], []
+    if low[depth + 1:] != [0] * rest:
+        head = _span_patterns(low, low[:depth + 1] + [255] * rest,
+                              depth + 1)
+        first += 1
+    if high[depth + 1:] != [255] * rest:
+        tail = _span_patterns(high[:depth + 1] + [0] * rest, high,
+                              depth + 1)
+        last -= 1
+    middle = []
+    if first <= last:
+        middle = [prefix + [(first, last)] + [FULL_OCTET] * rest]
+    return head + middle + tail
+
+
+def _fold_patterns(patterns):
+    """Join patterns that only differ by adjacent ranges in one octet.
+
+    For example '10.0.1.5' and '10.0.2.5' become '10.0.[1:2].5'. The
+    union of the patterns doesn't change.
+
+    :param patterns: a list of patterns, each four (low, high) pairs.
+    :returns: a list of patterns.
+    """
+    patterns = [tuple(pattern) for pattern in patterns]
+    changed = True
+    while changed:
+        changed = False
+        for position in range(4):
+            groups = {}
+            for pattern in patterns:
+                key = pattern[:position] + pattern[position + 1:]
+                groups.setdefault(key, []).append(pattern)
+            folded = []
+            for group in groups.values():
+                group.sort(key=lambda pattern, pos=position: pattern[pos])
+                current = group[0]
+                for pattern in group[1:]:
+                    if pattern[position][0] == current[position][1] + 1:
+                        current = (current[:position] +
+                                   ((current[position][0],
+                                     pattern[position][1]),) +
+                                   current[position + 1:])
+                        changed = True
+                    else:
+                        folded.append(current)
+                        current = pattern
+                folded.append(current)
+            patterns = folded
+    return sorted(patterns)
+
+
+def _format_pattern(octet_ranges):
+    return '.'.join(str(low) if low == high else '[{0}:{1}]'.format(low, high)
+                    for low, high in octet_ranges)
+
+
+def ranges_to_intervals(range_list):
+    """Split host patterns into IP address intervals and everything else.
+
+    :param range_list: a list of host patterns in Ansible format.
+    :returns: a tuple of (merged list of (first, last) integer address
+        intervals, list of the other patterns in their original order
+        without duplicates).
+    """
+    intervals = []
+    others = []
+    for pattern in range_list:
+        octet_ranges = _parse_ip_pattern(pattern)
+        if octet_ranges is None or \
+                _pattern_interval_count(octet_ranges) > MAX_PATTERN_INTERVALS:
+            if pattern not in others:
+                others.append(pattern)
+        else:
+            intervals.extend(_pattern_intervals(octet_ranges))
+    return merge_intervals(intervals), others
+
+
+def intervals_to_ranges(intervals):
+    """Write IP address intervals as compact Ansible host patterns.
+
+    :param intervals: a list of disjoint (first, last) address pairs.
+    :returns: a list of host patterns, sorted by address. No address is
+        covered by more than one of them.
+    """
+    patterns = []
+    for first, last in intervals:
+        patterns.extend(_span_patterns(_int_to_octets(first),
+                                       _int_to_octets(last)))
+    return [_format_pattern(pattern) for pattern in _fold_patterns(patterns)]
+
+
+def subtract_intervals(intervals, excluded):
+    """Remove excluded addresses from a list of intervals.
+
+    :param intervals: a list of (first, last) integer address pairs.
+    :param excluded: a list of (first, last) integer address pairs to
+        remove.
+    :returns: a sorted list of disjoint (first, last) pairs covering the
+        addresses of intervals that are not in excluded.
+    """
+    excluded = merge_intervals(excluded)
+    result = []
+    for first, last in merge_intervals(intervals):
+        for excluded_first, excluded_last in excluded:
+            if excluded_last < first:
+                continue
+            if excluded_first > last:
+                break
+            if excluded_first > first:
+                result.append((first, excluded_first - 1))
+            first = excluded_last + 1
+            if first > last:
+                break
+        if first <= last:
+            result.append((first, last))
+    return result
+
+
+def normalize_ranges(range_list):
+    """Rewrite host patterns so that no host is listed twice.
+
+    IP address patterns are merged into a canonical set of intervals,
+    so overlapping or adjacent ranges (including ranges from CIDR
+    notation) become one entry. Host name patterns are kept as they are,
+    minus exact duplicates, after the IP address patterns.
+
+    :param range_list: a list of host patterns in Ansible format, as
+        returned by read_ranges.
+    :returns: the normalized list of host patterns.
+    """
+    intervals, others = ranges_to_intervals(range_list)
+    return intervals_to_ranges(intervals) + others
+
+
+def exclude_ranges(range_list, exclude_list):
+    """Remove excluded hosts from a list of host patterns.
+
+    IP address ranges in exclude_list are subtracted from the IP address
+    ranges in range_list. Other patterns in exclude_list only remove
+    identical patterns from range_list; hosts they cover inside broader
+    patterns have to be filtered out after expansion.
+
+    :param range_list: a list of host patterns in Ansible format.
+    :param exclude_list: a list of host patterns in Ansible format.
+    :returns: the normalized list of host patterns that remain.
+    """
+    intervals, others = ranges_to_intervals(range_list)
+    excluded, excluded_others = ranges_to_intervals(exclude_list)
+    return (intervals_to_ranges(subtract_intervals(intervals, excluded)) +
+            [pattern for pattern in others if pattern not in excluded_others])
+
+
 class NotCIDRException(Exception):
     """Exception for when a string does not look like a CIDR range."""
 
@@ -0,0 +1,86 @@
+# Copyright (c) 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+"""Unit tests for ansible_executor.py"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from rho import ansible_executor, ansible_utils
+from rho.vault import Vault
+
+
+@unittest.skipUnless(ansible_executor.available(),
+                     'the Ansible API is not available')
+class TestAnsibleExecutor(unittest.TestCase):
+    """Run Ansible in-process against local connections."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.inventory = os.path.join(self.tmpdir, 'inventory')
+        self.log = os.path.join(self.tmpdir, 'log')
+        hosts = {'local1': {'ansible_connection': 'local'},
+                 'local2': {'ansible_connection': 'local'}}
+        Vault('secret').dump_as_yaml_to_file(
+            {'alpha': {'hosts': hosts, 'vars': {}}}, self.inventory)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_run_module(self):
+        """Results come back as rho_events records."""
+        events = []
+        ansible_executor.run_module(
+            self.inventory, 'secret', 'alpha', 'raw', 'echo hello', '2',
+            on_event=events.append, log_path=self.log, timeout=60)
+        results = sorted((event['host'], event['status'], event['stdout'])
+                         for event in events if 'host' in event)
+        self.assertEqual(results, [('local1', 'ok', 'hello\n'),
+                                   ('local2', 'ok', 'hello\n')])
+        with open(self.log) as log_file:
+            self.assertIn('local1 | ok | raw', log_file.read())
+
+    def test_failed_hosts(self):
+        """A run where hosts fail is an error unless told otherwise."""
+        events = []
+        ansible_executor.run_module(
+            self.inventory, 'secret', 'local1', 'raw', 'exit 1', '1',
+            on_event=events.append, log_path=self.log,
+            error_on_failure=False)
+        self.assertEqual([event['status'] for event in events
+                          if 'host' in event], ['failed'])
+        with self.assertRaises(ansible_utils.AnsibleProcessException):
+            ansible_executor.run_module(
+                self.inventory, 'secret', 'local1', 'raw', 'exit 1', '1',
+                log_path=self.log)
+
+    def test_timeout(self):
+        """A run that takes too long is stopped."""
+        with self.assertRaises(ansible_utils.AnsibleTimeoutException):
+            ansible_executor.run_module(
+                self.inventory, 'secret', 'local1', 'raw', 'sleep 30', '1',
+                log_path=self.log, timeout=1)
+
+    def test_subprocess_fallback(self):
+        """RHO_ANSIBLE_EXECUTOR=subprocess turns the API off."""
+        with mock.patch.dict(os.environ,
+                             {ansible_executor.EXECUTOR_ENV: 'subprocess'}):
+            self.assertFalse(ansible_executor.available())
+
+    def test_format_record(self):
+        """Records are logged one per line."""
+        self.assertEqual(ansible_executor.format_record(
+            {'task': 'raw', 'status': 'started'}), 'TASK [raw]')
+        self.assertEqual(ansible_executor.format_record(
+            {'host': 'h', 'task': 'raw', 'status': 'failed', 'msg': 'no'}),
+            'h | failed | raw | no')
@@ -9,6 +9,9 @@
 
 """Tests for rho/scancommand.py. logging"""
 
+import os
+import shutil
+import tempfile
 import unittest
 
 from rho import ansible_utils
@@ -65,3 +68,42 @@ class TestScanCommandLogging(unittest.TestCase):
                 }
             }
         )
+
+
+class TestEventStream(unittest.TestCase):
+    """Tests for reading the rho_events callback's output"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'events')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_with_event_stream(self):
+        env = ansible_utils.with_event_stream(
+            {'ANSIBLE_CALLBACK_PLUGINS': '/my/plugins'}, self.path)
+        self.assertEqual(env['ANSIBLE_CALLBACK_PLUGINS'],
+                         ansible_utils.CALLBACK_PLUGINS_PATH + os.pathsep +
+                         '/my/plugins')
+        self.assertEqual(env['ANSIBLE_CALLBACKS_ENABLED'], 'rho_events')
+        self.assertEqual(env['RHO_EVENTS_PATH'], self.path)
+        self.assertTrue(os.path.isfile(os.path.join(
+            ansible_utils.CALLBACK_PLUGINS_PATH, 'rho_events.py')))
+
+    def test_reads_incrementally(self):
+        reader = ansible_utils.EventReader(self.path)
+        self.assertEqual(reader.read(), [])
+        with open(self.path, 'w') as events:
+            events.write('{"host": "a", "status": "ok"}\n{"host": "b"')
+        self.assertEqual(reader.read(), [{'host': 'a', 'status': 'ok'}])
+        with open(self.path, 'a') as events:
+            events.write(', "status": "failed"}\n')
+        self.assertEqual(reader.read(), [{'host': 'b', 'status': 'failed'}])
+        self.assertEqual(reader.read(), [])
+
+    def test_skips_malformed_records(self):
+        with open(self.path, 'w') as events:
+            events.write('not json\n{"host": "a", "status": "ok"}\n')
+        self.assertEqual(ansible_utils.EventReader(self.path).read(),
+                         [{'host': 'a', 'status': 'ok'}])
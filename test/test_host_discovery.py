@@ -9,59 +9,482 @@
 
 """Unit tests for host_discovery.py"""
 
+import json
+import os
+import socket
+import tempfile
+import threading
 import unittest
 
-from rho import host_discovery
-
-
-class TestProcessPingOutput(unittest.TestCase):
-    """Unit tests for host_discovery.py"""
-
-    def test_process_ping_output(self):
-        """The output of a three-host scan"""
-        success, failed, unreachable = host_discovery.process_ping_output([
-            '192.168.50.11 | SUCCESS | rc=0 >>',
-            'Hello',
-            '192.168.50.12 | SUCCESS | rc=0 >>',
-            'Hello',
-            '192.168.50.10 | SUCCESS | rc=0 >>',
-            'Hello'])
-        self.assertEqual(success,
-                         set(['192.168.50.10',
-                              '192.168.50.11',
-                              '192.168.50.12']))
-        self.assertEqual(failed, set())
-        self.assertEqual(unreachable, set())
-
-    def test_process_ping_output_fail(self):
-        """The output of a three-host scan"""
-        success, failed, unreachable = host_discovery.process_ping_output([
-            '192.168.50.11 | UNREACHABLE! => {',
-            '     "changed": false,',
-            '     "msg": "Failed to connect to the host via ssh ...",',
-            '     "unreachable": true',
-            '    }',
-            'Hello',
-            '192.168.50.12 | SUCCESS | rc=0 >>',
-            'Hello',
-            '192.168.50.10 | SUCCESS | rc=0 >>',
-            'Hello'])
-        self.assertEqual(success,
-                         set(['192.168.50.10',
-                              '192.168.50.12']))
-        self.assertEqual(failed, set())
-        self.assertEqual(unreachable, set(['192.168.50.11']))
-
-    def test_partial_output(self):
-        """Partial lines of output, for instance from a timeout."""
-        success, failed, unreachable = host_discovery.process_ping_output([
-            '192.168.50.11 | UNREACH',
-            'Hello',
-            '192.168.50.12 | ',
-            'Hello',
-            '192.168',
-            'Hello'])
-
-        self.assertEqual(success, set())
-        self.assertEqual(failed, set())
-        self.assertEqual(unreachable, set())
+import mock
+import six
+from ansible.plugins.inventory import expand_hostname_range
+
+from rho import host_discovery, utilities
+
+
+class TestDiscoveryProgress(unittest.TestCase):
+    """Unit tests for following a discovery pass's event stream."""
+
+    def setUp(self):
+        self.events = tempfile.NamedTemporaryFile(mode='w', delete=False)
+
+    def tearDown(self):
+        self.events.close()
+        os.remove(self.events.name)
+
+    def write(self, *records):
+        """Write event records the way the rho_events callback does."""
+        for record in records:
+            self.events.write(json.dumps(record) + '\n')
+        self.events.flush()
+
+    def test_results(self):
+        """Hosts are sorted by the status of their result."""
+        progress = host_discovery.DiscoveryProgress(self.events.name,
+                                                    'cred', False)
+        self.write({'host': '192.168.50.10', 'status': 'ok'},
+                   {'host': '192.168.50.11', 'status': 'unreachable'})
+        progress.update()
+        self.write({'host': '192.168.50.12', 'status': 'failed'},
+                   {'host': '192.168.50.13', 'status': 'skipped'})
+        progress.stop()
+        self.assertEqual(progress.success, set(['192.168.50.10']))
+        self.assertEqual(progress.failed, set(['192.168.50.12']))
+        self.assertEqual(progress.unreachable, set(['192.168.50.11']))
+
+    def test_handle(self):
+        """Events can be handed over directly, without a stream."""
+        progress = host_discovery.DiscoveryProgress(None, 'cred', False)
+        progress.handle({'task': 'raw', 'status': 'started'})
+        progress.handle({'host': '10.0.0.1', 'status': 'ok'})
+        progress.stop()
+        self.assertEqual(progress.success, set(['10.0.0.1']))
+        self.assertEqual(progress.processed(), 1)
+
+    def test_identities(self):
+        """Successful hosts are identified from their ping output."""
+        progress = host_discovery.DiscoveryProgress(self.events.name,
+                                                    'cred', False)
+        self.write({'host': '10.0.0.1', 'status': 'ok',
+                    'stdout': 'Hello\ndb1\nssh-ed25519 AAAAC3Nz root@db1\n'},
+                   {'host': '10.0.0.2', 'status': 'ok',
+                    'stdout': 'Hello\n'})
+        progress.stop()
+        self.assertEqual(list(progress.identities), ['10.0.0.1'])
+
+    def test_partial_record(self):
+        """A record cut off by a timeout is ignored."""
+        progress = host_discovery.DiscoveryProgress(self.events.name,
+                                                    'cred', False)
+        self.write({'host': '192.168.50.10', 'status': 'ok'})
+        self.events.write('{"host": "192.168.50.11", "sta')
+        self.events.flush()
+        progress.stop()
+        self.assertEqual(progress.success, set(['192.168.50.10']))
+        self.assertEqual(progress.processed(), 1)
+
+    def test_report(self):
+        """Progress is printed every few hosts."""
+        progress = host_discovery.DiscoveryProgress(self.events.name,
+                                                    'cred', True)
+        self.write(*[{'host': str(index), 'status': 'ok'}
+                     for index in range(6)])
+        with mock.patch.object(progress, 'report') as report:
+            progress.update()
+        self.assertEqual(report.call_count, 1)
+
+
+class TestExpandHosts(unittest.TestCase):
+    """Unit tests for lazy host pattern expansion."""
+
+    def test_matches_ansible(self):
+        """Expansion gives the same hosts as Ansible, in the same order."""
+        for pattern in ['10.0.[1:3].[8:10]', 'db[01:10:3]node-[01:03]',
+                        'my-rhel[a:d].company.com', '[:2].example.com',
+                        'localhost']:
+            self.assertEqual(
+                list(host_discovery.iter_hostpattern(pattern)),
+                expand_hostname_range(pattern)
+                if '[' in pattern else [pattern])
+
+    def test_lazy(self):
+        """Expanding a huge range doesn't build a list."""
+        hosts = host_discovery.iter_hosts(['[0:255].[0:255].[0:255].[0:255]',
+                                           '1.2.3.4'])
+        self.assertEqual(next(hosts), '0.0.0.0')
+        self.assertEqual(next(hosts), '0.0.0.1')
+
+    def test_batches(self):
+        """Batches are bounded and cover every item once."""
+        self.assertEqual(
+            list(host_discovery.batches(
+                host_discovery.iter_hosts(['1.2.3.[1:5]']), 2)),
+            [['1.2.3.1', '1.2.3.2'], ['1.2.3.3', '1.2.3.4'], ['1.2.3.5']])
+
+    def test_candidate_hosts_exclusions(self):
+        """Excluded addresses and host names are never generated."""
+        hosts = host_discovery.candidate_hosts(
+            ['10.0.0.[1:6]', 'web[1:3].example.com', '10.0.0.[4:8]'],
+            ['10.0.0.[2:7]', 'web2.example.com'])
+        self.assertEqual(list(hosts), ['10.0.0.1', '10.0.0.8',
+                                       'web1.example.com',
+                                       'web3.example.com'])
+
+    def test_candidate_hosts_excluded_subnet_not_expanded(self):
+        """Subtracting a huge excluded range doesn't expand it."""
+        hosts = host_discovery.candidate_hosts(
+            ['10.[0:255].[0:255].[0:255]'],
+            [utilities.cidr_to_ansible('10.0.0.0/9')])
+        self.assertEqual(next(hosts), '10.128.0.0')
+
+    def test_ping_in_chunks(self):
+        """Each ping inventory holds at most one chunk of hosts."""
+        with mock.patch.object(host_discovery, '_ping_chunk',
+                               return_value=(set(['1.2.3.2']), set(),
+                                             set(), {})) as ping_chunk:
+            success, ports, auths, failed, unreachable, _ = \
+                host_discovery.create_ping_inventory(
+                    None, 'pass', ['1.2.3.[1:5]'], 22, {'name': 'cred'},
+                    '50', 0, chunk_size=2)
+
+        self.assertEqual([call[0][2] for call in ping_chunk.call_args_list],
+                         [['1.2.3.1', '1.2.3.2'], ['1.2.3.3', '1.2.3.4'],
+                          ['1.2.3.5']])
+        self.assertEqual(success, ['1.2.3.2'])
+        self.assertEqual(ports, {'1.2.3.2': 22})
+        self.assertEqual(auths, {'1.2.3.2': [{'name': 'cred'}]})
+        self.assertEqual((failed, unreachable), ([], []))
+
+
+class TestHostIdentity(unittest.TestCase):
+    """Unit tests for telling machines apart by their SSH host keys."""
+
+    RSA = 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQC7 root@db1'
+    ED25519 = 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIOMq root@db1'
+
+    def test_same_machine(self):
+        """Key order and line endings don't change the identity."""
+        first = host_discovery.host_identity(
+            'Hello\ndb1\n' + self.RSA + '\n' + self.ED25519 + '\n')
+        second = host_discovery.host_identity(
+            'Hello\r\ndb1\r\n' + self.ED25519 + '\r\n' + self.RSA)
+        self.assertEqual(first, second)
+        self.assertTrue(first.startswith('db1 SHA256:'))
+
+    def test_cloned_keys(self):
+        """Machines with copied host keys but different names differ."""
+        self.assertNotEqual(
+            host_discovery.host_identity('Hello\ndb1\n' + self.RSA),
+            host_discovery.host_identity('Hello\ndb2\n' + self.RSA))
+
+    def test_no_keys(self):
+        """Without readable host keys a machine has no identity."""
+        self.assertIsNone(host_discovery.host_identity('Hello\ndb1\n'))
+
+    def test_collapse_aliases(self):
+        """The first address of each machine is kept."""
+        self.assertEqual(
+            host_discovery.collapse_aliases(
+                ['a', 'b', 'c', 'd'], {'a': 'x', 'b': 'y', 'c': 'x'}),
+            (['a', 'b', 'd'], {'a': ['c']}))
+
+
+class TestDiscoverHosts(unittest.TestCase):
+    """Unit tests for the concurrent discovery scheduler."""
+
+    CRED_1 = {'id': '1', 'name': 'cred_1'}
+    CRED_2 = {'id': '2', 'name': 'cred_2'}
+
+    def test_subnet_key(self):
+        """Statistics are kept per /24 network, for addresses only."""
+        self.assertEqual(host_discovery.subnet_key('10.0.1.17'),
+                         '10.0.1.0/24')
+        self.assertIsNone(host_discovery.subnet_key('db1.example.com'))
+
+    def test_credential_order_rotates(self):
+        """Without statistics, hosts start on different credentials."""
+        creds = [{'id': '1'}, {'id': '2'}, {'id': '3'}]
+        self.assertEqual(
+            [host_discovery.credential_order('10.0.0.1', index, creds, {})
+             for index in range(4)],
+            [[0, 1, 2], [1, 2, 0], [2, 0, 1], [0, 1, 2]])
+
+    def test_credential_order_learned(self):
+        """Credentials that work on a subnet are tried first there."""
+        creds = [{'id': '1'}, {'id': '2'}, {'id': '3'}]
+        stats = {'10.0.0.0/24': {'3': [9, 10], '1': [0, 10]}}
+        self.assertEqual(
+            host_discovery.credential_order('10.0.0.1', 0, creds, stats),
+            [2, 1, 0])
+        self.assertEqual(
+            host_discovery.credential_order('10.0.1.1', 0, creds, stats),
+            [0, 1, 2])
+
+    @staticmethod
+    def fake_ping(working, identities=None):
+        """Make a create_ping_inventory stand-in.
+
+        :param working: map from credential id to the hosts it works on.
+        :param identities: map from hosts to their host_identity.
+        """
+        identities = identities or {}
+
+        def ping(vault, vault_pass, hosts, port, credential, *args,
+                 **kwargs):
+            # pylint: disable=unused-argument
+            success = [host for host in hosts
+                       if host in working[credential['id']]]
+            failed = [host for host in hosts if host not in success]
+            return (success, dict((host, port) for host in success),
+                    dict((host, [credential]) for host in success),
+                    failed, [], dict((host, identities[host])
+                                     for host in success
+                                     if host in identities))
+        return ping
+
+    def test_discover_hosts(self):
+        """Hosts are matched with whichever credential works."""
+        working = {'1': ['1.2.3.1', '1.2.3.4'], '2': ['1.2.3.2']}
+        with mock.patch.object(host_discovery, 'create_ping_inventory',
+                               side_effect=self.fake_ping(working)) as ping:
+            success, ports, auths, failed, unreachable, _ = \
+                host_discovery.discover_hosts(
+                    None, 'pass', ['1.2.3.[1:4]'], 22,
+                    [self.CRED_1, self.CRED_2], '50', 0, probe=False)
+
+        self.assertEqual(sorted(success), ['1.2.3.1', '1.2.3.2', '1.2.3.4'])
+        self.assertEqual(ports['1.2.3.2'], 22)
+        self.assertEqual(auths['1.2.3.2'], [self.CRED_2])
+        self.assertEqual(auths['1.2.3.4'], [self.CRED_1])
+        self.assertEqual(failed, ['1.2.3.3'])
+        self.assertEqual(unreachable, 0)
+        # Two rounds of two concurrent passes, each on one shard. The
+        # second round only retries the hosts that failed.
+        self.assertEqual(
+            sorted(len(call[0][2]) for call in ping.call_args_list),
+            [1, 1, 2, 2])
+
+    def test_learned_order_takes_one_round(self):
+        """With statistics, each host is tried with the right auth first."""
+        working = {'1': ['10.0.1.1', '10.0.1.2'],
+                   '2': ['10.0.2.1', '10.0.2.2']}
+        stats = {'10.0.1.0/24': {'1': [5, 5], '2': [0, 5]},
+                 '10.0.2.0/24': {'1': [0, 5], '2': [5, 5]}}
+        with mock.patch.object(host_discovery, 'create_ping_inventory',
+                               side_effect=self.fake_ping(working)) as ping:
+            success, _, _, failed, _, _ = host_discovery.discover_hosts(
+                None, 'pass', ['10.0.1.[1:2]', '10.0.2.[1:2]'], 22,
+                [self.CRED_1, self.CRED_2], '50', 0, probe=False,
+                stats=stats)
+
+        self.assertEqual(len(success), 4)
+        self.assertEqual(failed, [])
+        self.assertEqual(ping.call_count, 2)
+        self.assertEqual(stats['10.0.1.0/24']['1'], [7, 7])
+
+    def test_stats_recorded(self):
+        """Successes and failures are counted per credential per /24."""
+        working = {'1': ['1.2.3.1'], '2': []}
+        stats = {}
+        with mock.patch.object(host_discovery, 'create_ping_inventory',
+                               side_effect=self.fake_ping(working)):
+            host_discovery.discover_hosts(
+                None, 'pass', ['1.2.3.[1:2]'], 22,
+                [self.CRED_1, self.CRED_2], '50', 0, probe=False,
+                stats=stats)
+
+        self.assertEqual(stats, {'1.2.3.0/24': {'1': [1, 2], '2': [0, 1]}})
+
+    def test_aliases_collapsed(self):
+        """Addresses of the same machine are only scanned once."""
+        working = {'1': ['1.2.3.1', '1.2.3.2', '1.2.3.3'], '2': []}
+        identities = {'1.2.3.1': 'db1 SHA256:abc', '1.2.3.3': 'db1 SHA256:abc'}
+        with mock.patch.object(
+                host_discovery, 'create_ping_inventory',
+                side_effect=self.fake_ping(working, identities)):
+            success, ports, _, _, _, aliases = \
+                host_discovery.discover_hosts(
+                    None, 'pass', ['1.2.3.[1:3]'], 22,
+                    [self.CRED_1, self.CRED_2], '50', 0, probe=False)
+
+        self.assertEqual(sorted(success), ['1.2.3.1', '1.2.3.2'])
+        self.assertEqual(aliases, {'1.2.3.1': ['1.2.3.3']})
+
+    def test_unreachable_hosts_are_not_retried(self):
+        """Unreachable hosts leave discovery unless an SSH key was used."""
+        def ping(vault, vault_pass, hosts, *args, **kwargs):
+            # pylint: disable=unused-argument
+            return [], {}, {}, [], list(hosts), {}
+
+        unreachable_log = six.StringIO()
+        with mock.patch.object(host_discovery, 'create_ping_inventory',
+                               side_effect=ping) as ping_mock:
+            success, _, _, failed, unreachable, _ = \
+                host_discovery.discover_hosts(
+                    None, 'pass', ['1.2.3.4'], 22,
+                    [self.CRED_1, self.CRED_2], '50', 0, probe=False,
+                    unreachable_log=unreachable_log)
+
+        self.assertEqual(success, [])
+        self.assertEqual(failed, [])
+        self.assertEqual(unreachable, 1)
+        self.assertEqual(unreachable_log.getvalue(),
+                         '1.2.3.4: unreachable by Ansible\n')
+        self.assertEqual(ping_mock.call_count, 1)
+
+
+class TestDiscoveryCache(unittest.TestCase):
+    """Unit tests for the per-host discovery cache."""
+
+    CRED_1 = {'id': '1', 'name': 'cred_1'}
+    CRED_2 = {'id': '2', 'name': 'cred_2'}
+
+    def discover(self, cache, working, cache_ttl=0):
+        """Run discovery on 1.2.3.[1:3] with a fake ping."""
+        with mock.patch.object(host_discovery, 'create_ping_inventory',
+                               side_effect=TestDiscoverHosts.fake_ping(
+                                   working)) as ping, \
+                mock.patch.object(host_discovery.time, 'time',
+                                  return_value=10000):
+            result = host_discovery.discover_hosts(
+                None, 'pass', ['1.2.3.[1:3]'], 22,
+                [self.CRED_1, self.CRED_2], '50', 0, probe=False,
+                cache=cache, cache_ttl=cache_ttl)
+        return result, [(sorted(call[0][2]), call[0][4]['id'])
+                        for call in ping.call_args_list]
+
+    def test_records_success(self):
+        """Successful hosts are recorded with the auth that worked."""
+        cache = {}
+        self.discover(cache, {'1': ['1.2.3.1'], '2': ['1.2.3.2']})
+        self.assertEqual(cache, {
+            '1.2.3.1': {'auth_id': '1', 'port': 22, 'last_success': 10000,
+                        'failures': 0},
+            '1.2.3.2': {'auth_id': '2', 'port': 22, 'last_success': 10000,
+                        'failures': 0}})
+
+    def test_fresh_records_are_trusted(self):
+        """Hosts with a fresh record are not contacted."""
+        cache = {'1.2.3.1': {'auth_id': '2', 'port': 22,
+                             'last_success': 9000, 'failures': 0},
+                 '1.2.3.2': {'auth_id': '2', 'port': 22,
+                             'last_success': 1000, 'failures': 0}}
+        (success, _, auths, _, _, _), calls = self.discover(
+            cache, {'1': ['1.2.3.3'], '2': ['1.2.3.2']}, cache_ttl=3600)
+        self.assertEqual(sorted(success), ['1.2.3.1', '1.2.3.2', '1.2.3.3'])
+        self.assertEqual(auths['1.2.3.1'], [self.CRED_2])
+        # The stale host is revalidated with its cached auth on its own,
+        # before the uncached host goes through the shards.
+        self.assertEqual(calls[0], (['1.2.3.2'], '2'))
+        self.assertNotIn('1.2.3.1', [host for hosts, _ in calls
+                                     for host in hosts])
+        self.assertEqual(cache['1.2.3.1']['last_success'], 9000)
+        self.assertEqual(cache['1.2.3.2']['last_success'], 10000)
+
+    def test_failures_expire_records(self):
+        """Records are dropped after repeated failed discoveries."""
+        cache = {'1.2.3.1': {'auth_id': '1', 'port': 22,
+                             'last_success': 9000, 'failures': 0}}
+        for failures in range(1, host_discovery.DISCOVERY_CACHE_MAX_FAILURES):
+            self.discover(cache, {'1': [], '2': []})
+            self.assertEqual(cache['1.2.3.1']['failures'], failures)
+        self.discover(cache, {'1': [], '2': []})
+        self.assertEqual(cache, {})
+
+    def test_load_missing_cache(self):
+        """A profile without a cache file starts with an empty cache."""
+        self.assertEqual(
+            host_discovery.load_discovery_cache(None, '/no/such/cache'), {})
+
+
+class TestDiscoveryTimeouts(unittest.TestCase):
+    """Unit tests for per-host discovery timeouts."""
+
+    def test_connect_timeouts(self):
+        """Only slow hosts get longer timeouts than the bulk."""
+        rtts = dict(('10.0.0.%d' % index, 0.01) for index in range(100))
+        rtts['10.0.1.1'] = 0.5
+        rtts['10.0.1.2'] = 10
+        timeouts = host_discovery.connect_timeouts(rtts)
+        self.assertEqual(timeouts['10.0.0.1'],
+                         host_discovery.MIN_CONNECT_TIMEOUT)
+        self.assertEqual(timeouts['10.0.1.1'], 10)
+        self.assertEqual(timeouts['10.0.1.2'],
+                         host_discovery.MAX_CONNECT_TIMEOUT)
+
+    def test_slow_network(self):
+        """When every host is slow, every timeout grows."""
+        rtts = dict(('10.0.0.%d' % index, 0.4) for index in range(10))
+        self.assertEqual(set(host_discovery.connect_timeouts(rtts).values()),
+                         set([8]))
+
+    def test_pass_timeout(self):
+        """A pass gets one slowest-host deadline per wave of forks."""
+        with mock.patch.dict('os.environ'):
+            os.environ.pop('RHO_DISCOVERY_TIMEOUT', None)
+            self.assertEqual(host_discovery.pass_timeout([3] * 99 + [5], '50'),
+                             2 * host_discovery.host_deadline(5))
+            os.environ['RHO_DISCOVERY_TIMEOUT'] = '2'
+            self.assertEqual(host_discovery.pass_timeout([3] * 100, '50'),
+                             240)
+
+
+class TestProbeSSHHosts(unittest.TestCase):
+    """Unit tests for the SSH banner pre-probe."""
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+
+    def serve(self, banner):
+        """Accept one connection and send it a banner."""
+        def accept():
+            conn, _ = self.server.accept()
+            conn.sendall(banner)
+            conn.close()
+        thread = threading.Thread(target=accept)
+        thread.start()
+        return thread
+
+    def test_ssh_banner(self):
+        """A host that sends an SSH banner is live."""
+        thread = self.serve(b'SSH-2.0-OpenSSH_7.4\r\n')
+        live, skipped, rtts = host_discovery.probe_ssh_hosts(
+            ['127.0.0.1'], self.port, timeout=5)
+        thread.join()
+        self.assertEqual(live, ['127.0.0.1'])
+        self.assertEqual(skipped, {})
+        self.assertEqual(list(rtts), ['127.0.0.1'])
+        self.assertTrue(0 <= rtts['127.0.0.1'] < 5)
+
+    def test_not_ssh(self):
+        """A host that answers with something else is skipped."""
+        thread = self.serve(b'220 smtp.example.com ESMTP\r\n')
+        live, skipped, _ = host_discovery.probe_ssh_hosts(
+            ['127.0.0.1'], self.port, timeout=5)
+        thread.join()
+        self.assertEqual(live, [])
+        self.assertEqual(skipped, {'127.0.0.1': 'closed the connection '
+                                                'without an SSH banner'})
+
+    def test_silent_host(self):
+        """A host that never sends a banner times out."""
+        live, skipped, _ = host_discovery.probe_ssh_hosts(
+            ['127.0.0.1'], self.port, timeout=0.2)
+        self.assertEqual(live, [])
+        self.assertEqual(skipped, {'127.0.0.1': 'timed out waiting for an '
+                                                'SSH banner'})
+
+    def test_connection_refused(self):
+        """A host with nothing listening is skipped."""
+        self.server.close()
+        live, skipped, _ = host_discovery.probe_ssh_hosts(
+            ['127.0.0.1'], self.port, timeout=5)
+        self.assertEqual(live, [])
+        self.assertEqual(skipped, {'127.0.0.1': 'connection refused'})
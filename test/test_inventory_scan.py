@@ -14,9 +14,20 @@
 # main are in test_clicommand.py, becuase that's where the
 # infrastructure for mocking out credentials and profiles is.
 
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
-from rho import inventory_scan
+import mock
+import six
+import yaml
+
+from rho import ansible_utils, inventory_scan
+from rho.vault import Vault
 
 
 # pylint: disable=invalid-name
@@ -53,6 +64,17 @@ class TestInventoryDictFunctions(unittest.TestCase):
              {'hosts':
               {'host_ip_1': self.auth_as_vars('host_ip_1')}}})
 
+    def test_make_inventory_dict_aliases(self):
+        """Other addresses of a host are passed on for the report."""
+        host_vars = self.auth_as_vars('host_ip_1')
+        host_vars['rho_aliases'] = 'host_ip_2,host_ip_3'
+        self.assertEqual(
+            inventory_scan.make_inventory_dict(
+                ['host_ip_1'], {'host_ip_1': '22'},
+                {'host_ip_1': [self.AUTH]},
+                alias_map={'host_ip_1': ['host_ip_2', 'host_ip_3']}),
+            {'group0': {'hosts': {'host_ip_1': host_vars}}})
+
     def test_round_trip(self):
         """Test make_inventory_dict with multiple groups."""
 
@@ -78,3 +100,199 @@ class TestInventoryDictFunctions(unittest.TestCase):
             {'group0': ['host_ip_1'],
              'group1': ['host_ip_2'],
              'group2': ['host_ip_3']})
+
+
+class TestInventoryShards(unittest.TestCase):
+    """Unit tests for per-group inventory files."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.tmpdir, 'profile_hosts.yml')
+        self.shards_path = os.path.join(self.tmpdir, 'profile_hosts.d')
+        self.vault = Vault('password')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def load(self, path):
+        """Decrypt and parse a YAML file."""
+        return yaml.safe_load(self.vault.load_secure_file(path))
+
+    def test_write_inventory_shards(self):
+        """Each group gets its own file, and the index lists them."""
+        os.makedirs(self.shards_path)
+        stale = inventory_scan.shard_path(self.shards_path, 'group9')
+        open(stale, 'w').close()
+        yml_dict = {'group0': {'hosts': {'host_1': {'ansible_port': 22}}},
+                    'group1': {'hosts': {'host_2': {'ansible_port': 22}}}}
+        inventory_scan.write_inventory_shards(
+            self.vault, yml_dict, self.index_path, self.shards_path)
+        self.assertEqual(sorted(os.listdir(self.shards_path)),
+                         ['group0.yml', 'group1.yml'])
+        self.assertEqual(
+            self.load(inventory_scan.shard_path(self.shards_path, 'group1')),
+            {'group1': {'hosts': {'host_2': {'ansible_port': 22}}}})
+        self.assertEqual(self.load(self.index_path),
+                         {'group0': ['host_1'], 'group1': ['host_2']})
+
+    def test_load_host_groups(self):
+        """Indexes and whole inventories both give the groups."""
+        vault = mock.Mock()
+        vault.load_as_yaml.return_value = {'group0': ['host_1']}
+        self.assertEqual(
+            inventory_scan.load_host_groups(vault, self.index_path),
+            ({'group0': ['host_1']}, True))
+        vault.load_as_yaml.return_value = {
+            'group0': {'hosts': {'host_1': {'ansible_port': 22}}}}
+        self.assertEqual(
+            inventory_scan.load_host_groups(vault, self.index_path),
+            ({'group0': ['host_1']}, False))
+
+
+class TestGroupScheduling(unittest.TestCase):
+    """Unit tests for scanning groups concurrently."""
+
+    def test_scan_concurrency(self):
+        """Enough groups run to use the forks, up to one per CPU."""
+        self.assertEqual(inventory_scan.scan_concurrency('50', 10, cpus=64),
+                         5)
+        self.assertEqual(inventory_scan.scan_concurrency('50', 10, cpus=2),
+                         2)
+        self.assertEqual(inventory_scan.scan_concurrency('5', 10, cpus=64),
+                         1)
+
+    def test_run_groups(self):
+        """Groups overlap, and results come back in group order."""
+        groups = ['group%d' % index for index in range(6)]
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def scan_group(group):
+            """Record how many groups run at once."""
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return [group]
+
+        results = inventory_scan.run_groups(groups, scan_group, 3)
+        self.assertEqual(results, [[group] for group in groups])
+        self.assertEqual(running[1], 3)
+
+    def test_run_groups_error(self):
+        """A failing group stops the scan and its error is raised."""
+        started = []
+
+        def scan_group(group):
+            """Fail on the first group."""
+            started.append(group)
+            if group == 'group0':
+                raise ValueError(group)
+            return []
+
+        with self.assertRaises(ValueError):
+            inventory_scan.run_groups(['group0', 'group1', 'group2'],
+                                      scan_group, 1)
+        self.assertEqual(started, ['group0'])
+
+    @mock.patch('rho.ansible_executor.available', return_value=True)
+    def test_scan_in_one_run(self, _):
+        """Hosts' results are collected as they write them."""
+        collected = []
+
+        def run_playbook(*args, **kwargs):
+            """Write results the way the write_host role does."""
+            results_dir = args[4]['results_dir']
+            kwargs['on_event']({'task': 'write_host : ' +
+                                inventory_scan.WRITE_HOST_TASK,
+                                'status': 'started'})
+            for host in ['h2', 'h1']:
+                with open(os.path.join(results_dir, host + '.json'),
+                          'w') as results_file:
+                    json.dump({'uname': {'uname.hostname': host}},
+                              results_file)
+                kwargs['on_event'](
+                    {'host': host, 'status': 'ok',
+                     'task': 'write_host : ' +
+                             inventory_scan.WRITE_HOST_TASK})
+                collected.append(os.listdir(results_dir))
+            raise ansible_utils.AnsibleTimeoutException()
+
+        with mock.patch('rho.ansible_executor.run_playbook',
+                        side_effect=run_playbook):
+            facts, durations = inventory_scan.scan_in_one_run(
+                'playbook', 'inventory',
+                {'group0': ['h1', 'h2'], 'group1': ['h3']}, 'pass',
+                ['uname.hostname'], [], '50', {}, os.devnull, 0)
+        self.assertEqual(collected, [[], []])
+        self.assertEqual([fact['uname.hostname'] for fact in facts],
+                         [b'h1', b'h2'])
+        self.assertEqual(sorted(durations), ['h1', 'h2', 'h3'])
+        self.assertEqual(durations['h3'], 600)
+
+
+class TestScanTimes(unittest.TestCase):
+    """Unit tests for grouping hosts by their scan time history."""
+
+    def test_balance_groups(self):
+        """Slow hosts get groups of their own, and come first."""
+        hosts = ['host%d' % index for index in range(10)]
+        scan_times = dict((host, 10) for host in hosts)
+        scan_times['host7'] = 600
+        groups = inventory_scan.balance_groups(hosts, scan_times, 3)
+        self.assertEqual(groups[0], ['host7'])
+        self.assertEqual(sorted(len(group) for group in groups[1:]),
+                         [4, 5])
+
+    def test_unknown_hosts(self):
+        """Hosts without history are predicted from the others."""
+        self.assertEqual(
+            inventory_scan.predicted_scan_times(
+                ['a', 'b', 'c', 'd'], {'a': 10, 'b': 20, 'c': 300}),
+            {'a': 10, 'b': 20, 'c': 300, 'd': 20})
+        self.assertEqual(
+            inventory_scan.predicted_scan_times(['a'], {}),
+            {'a': inventory_scan.DEFAULT_HOST_SCAN_TIME})
+
+    def test_make_inventory_dict(self):
+        """The inventory is balanced once there is history."""
+        hosts = ['host%d' % index for index in range(4)]
+        auth = {'id': '1', 'name': 'auth', 'username': 'user'}
+        val = inventory_scan.make_inventory_dict(
+            hosts, dict((host, 22) for host in hosts),
+            dict((host, [auth]) for host in hosts), group_size=2,
+            scan_times={'host0': 10, 'host1': 10, 'host2': 10,
+                        'host3': 100})
+        self.assertEqual(inventory_scan.hosts_by_group(val),
+                         {'group0': ['host3'],
+                          'group1': ['host0', 'host1', 'host2']})
+
+    def test_update_scan_times(self):
+        """New durations are averaged into the history."""
+        scan_times = {'a': 10}
+        inventory_scan.update_scan_times(scan_times, {'a': 30, 'b': 5})
+        self.assertEqual(scan_times, {'a': 20, 'b': 5})
+
+    def test_scan_timeout(self):
+        """Timeouts follow the slowest host once all are known."""
+        self.assertEqual(inventory_scan.scan_timeout(
+            ['a', 'b'], '50', {'a': 10, 'b': 200}, 10), 10)
+        self.assertEqual(inventory_scan.scan_timeout(
+            ['a', 'b'], '50', {'a': 10, 'b': 30}, 10), 2)
+        self.assertEqual(inventory_scan.scan_timeout(
+            ['a', 'b'], '1', {'a': 10}, 10), 30)
+
+    def test_scan_timer(self):
+        """Hosts are charged for their own time on each task."""
+        clock = iter([0, 1, 5, 10, 12, 100]).__next__ \
+            if six.PY3 else iter([0, 1, 5, 10, 12, 100]).next
+        timer = inventory_scan.ScanTimer(clock)
+        timer.handle({'task': 'one', 'status': 'started'})
+        timer.handle({'host': 'a', 'status': 'ok'})
+        timer.handle({'host': 'b', 'status': 'ok'})
+        timer.handle({'task': 'two', 'status': 'started'})
+        timer.handle({'host': 'a', 'status': 'ok'})
+        timer.timed_out(['a', 'b'], 100)
+        self.assertEqual(timer.durations, {'a': 3, 'b': 100})
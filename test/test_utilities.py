@@ -114,6 +114,85 @@ class TestReadRanges(unittest.TestCase):
             utilities.read_ranges(range_list)
 
 
+class TestNormalizeRanges(unittest.TestCase):
+    def test_overlapping_ranges_merge(self):
+        range_list = ['192.168.1.[10:20]',
+                      '192.168.1.[15:30]',
+                      '192.168.1.31']
+        self.assertEqual(utilities.normalize_ranges(range_list),
+                         ['192.168.1.[10:31]'])
+
+    def test_cidr_covers_smaller_ranges(self):
+        range_list = ['10.0.0.[5:9]',
+                      utilities.cidr_to_ansible('10.0.0.0/16'),
+                      '10.0.7.1']
+        self.assertEqual(utilities.normalize_ranges(range_list),
+                         ['10.0.[0:255].[0:255]'])
+
+    def test_adjacent_subnets_collapse(self):
+        range_list = ['10.1.[0:1].[0:255]', '10.1.[2:3].[0:255]']
+        self.assertEqual(utilities.normalize_ranges(range_list),
+                         ['10.1.[0:3].[0:255]'])
+
+    def test_lattice_patterns_fold(self):
+        range_list = ['10.10.[1:20].25', '10.10.[1:20].[1:24]']
+        self.assertEqual(utilities.normalize_ranges(range_list),
+                         ['10.10.[1:20].[1:25]'])
+
+    def test_unaligned_interval(self):
+        range_list = ['10.1.0.[7:255]', '10.1.[1:4].[0:255]', '10.1.5.[0:3]']
+        self.assertEqual(utilities.normalize_ranges(range_list),
+                         ['10.1.0.[7:255]', '10.1.[1:4].[0:255]',
+                          '10.1.5.[0:3]'])
+
+    def test_hostnames_deduplicated(self):
+        range_list = ['mycentos.com', '1.2.3.4',
+                      'my-rhel[a:d].company.com', 'mycentos.com']
+        self.assertEqual(utilities.normalize_ranges(range_list),
+                         ['1.2.3.4', 'mycentos.com',
+                          'my-rhel[a:d].company.com'])
+
+    def test_same_hosts_as_input(self):
+        from rho.host_discovery import iter_hosts
+        range_list = ['10.10.181.9',
+                      '10.10.128.[1:25]',
+                      '10.10.[1:20].25',
+                      '10.10.[1:20].[1:25]',
+                      '10.10.128.[20:40]',
+                      '10.10.[0:3].[250:255]',
+                      'localhost']
+        normalized = utilities.normalize_ranges(range_list)
+        hosts = list(iter_hosts(normalized))
+        self.assertEqual(len(hosts), len(set(hosts)))
+        self.assertEqual(set(hosts), set(iter_hosts(range_list)))
+
+
+class TestExcludeRanges(unittest.TestCase):
+    def test_subtract_intervals(self):
+        self.assertEqual(
+            utilities.subtract_intervals([(0, 100), (200, 300)],
+                                         [(10, 20), (50, 250), (300, 400)]),
+            [(0, 9), (21, 49), (251, 299)])
+
+    def test_excluded_subnet(self):
+        range_list = ['192.168.0.[0:255]', '192.168.1.[0:255]']
+        self.assertEqual(
+            utilities.exclude_ranges(range_list, ['192.168.0.[128:255]']),
+            ['192.168.0.[0:127]', '192.168.1.[0:255]'])
+
+    def test_exclude_everything(self):
+        self.assertEqual(
+            utilities.exclude_ranges(['10.0.0.[1:5]', 'myhost'],
+                                     [utilities.cidr_to_ansible('10.0.0.0/24'),
+                                      'myhost']),
+            [])
+
+    def test_exclude_outside_range(self):
+        self.assertEqual(
+            utilities.exclude_ranges(['10.0.0.[1:5]'], ['10.0.1.[1:5]']),
+            ['10.0.0.[1:5]'])
+
+
 class TestCIDRToAnsible(unittest.TestCase):
     def test_wrong_format(self):
         with self.assertRaises(utilities.NotCIDRException):